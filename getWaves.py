@@ -40,6 +40,9 @@ else:
 import rodsPythonThings
 import rodsPlotTfr as rodstfr
 
+import getnPlotFetch
+import getnPlotCache
+
 ############  For timer 
 startTime = datetime.now()
 
@@ -97,10 +100,13 @@ filenameSeparator = "."
 filenameSeparator2 = "-"
 dirnameSeparator = "/"
 clientTimeout = 20
+cacheDir = '~/.cache/getnPlot'
+menuTtl = 300
 today = datetime.utcnow().date()
 datimNow = datetime.utcnow()
 wwsIP = '172.17.102.60'
 wwsPort = 16022
+wwsConnections = 8
 
 
 
@@ -159,11 +165,12 @@ st = Stream()
 
 # Waveserver
 # Define wave server
-client = Client(wwsIP, wwsPort, clientTimeout)
+pool = getnPlotFetch.WaveserverPool(wwsIP, wwsPort, clientTimeout, wwsConnections, getnPlotCache.MenuCache(cacheDir, menuTtl))
 # Fetch all data from waveserver
-info = client.get_availability(network='*', station='*', channel='*')
-for net, sta, loc, cha, start, end in info:
-    st += client.get_waveforms(net, sta, loc, cha, datimBeg, datimEnd)
+info = pool.getAvailability(network='*', station='*', channel='*')
+nslcs = [ (net, sta, loc, cha) for net, sta, loc, cha, start, end in info ]
+st += getnPlotFetch.fetchWaveserver( pool, nslcs, datimBeg, datimEnd )
+pool.close()
 
 
 ############  Save data as miniseed and exit
@@ -36,12 +36,27 @@ from obspy.clients.filesystem.sds import Client as sdsClient
 
 ############  Location of python modules is different on opsproc2
 hostname = socket.gethostname()
-sys.path.append( '/'.join( [os.path.expanduser('~'), 'src/pythonModules' ] ) )
+pathModules = '/'.join( [os.path.expanduser('~'), 'src/pythonModules' ] )
+if pathModules not in sys.path:
+    sys.path.append( pathModules )
 
 import rodsPythonThings
 import rodsPlotTfr as rodstfr
 #import rodsPlotLongSgram as rodslsgram
 
+import getnPlotChannels
+import getnPlotFetch
+import getnPlotCache
+import getnPlotRun
+import getnPlotServe
+import getnPlotBatch
+import getnPlotLayout
+import getnPlotDraw
+import getnPlotSds
+import getnPlotEvents
+import getnPlotStream
+import getnPlotBlock
+
 
 
 ############  For timer 
@@ -56,18 +71,32 @@ parser = argparse.ArgumentParser( prog='getnPlot', description='Get seismic data
 
 parser.add_argument('-v', '--version', action='version', version='%(prog)s 2.0-dev')
 
-choices = ['getnplot','get','plot','test']
+choices = ['getnplot','get','plot','test','serve']
 parser.add_argument('--mode', default='getnplot', choices=choices, help='Mode of operation: '+' | '.join(choices), metavar='')
 parser.add_argument('-q', '--quiet', action='store_true', help='No screen output')
+parser.add_argument('--socket', default=getnPlotServe.socketDefault, help='Unix socket for getnPlot server (--mode serve)', metavar='')
+parser.add_argument('--batch', default='', help='File of events (date time [minutes] [tag] per line), each plotted with the other options', metavar='')
+choices = getnPlotLayout.layoutChoices
+parser.add_argument('--layout', default='', help='Composite plot made of several plots: '+' | '.join(choices), metavar='')
+parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Number of processes for batch mode, several kinds of plot and layouts, and of threads for processing stations', metavar='')
 
 choices=['auto','wws','mseed','cont', 'event', 'filename']
-parser.add_argument('--source', default='auto', help='Data source (auto tries wws then mseed then cont): '+' | '.join(choices), metavar='')
+parser.add_argument('--source', default='auto', help='Data source (auto reads wws and mseed at once, each channel from whichever has it first): '+' | '.join(choices), metavar='')
 parser.add_argument('--wwsip', default='172.17.102.60', help='Hostname or IP address of winston wave server', metavar='')
 parser.add_argument('--wwsport', default=16022, help='Port of winston wave server', metavar='')
+parser.add_argument('--nocache', action='store_true', help='Do not use local cache of waveform data')
+parser.add_argument('--cachedir', default='~/.cache/getnPlot', help='Directory for local cache of waveform data', metavar='')
+parser.add_argument('--cachesize', type=float, default=2000, help='Maximum size (Mbytes) of local cache of waveform data', metavar='')
+parser.add_argument('--menuttl', type=float, default=300, help='Seconds for which a cached winston wave server menu is reused (0 to always fetch)', metavar='')
+parser.add_argument('--chunk', type=float, default=1.0, help='Length (hours) of chunks in which windows longer than a day are read from mseed files (0 to read them whole)', metavar='')
+parser.add_argument('--prefetch', type=int, default=2, help='Number of windows loaded ahead in the background when working through chunks of a long window, a batch, or server jobs that follow on (0 for none)', metavar='')
+parser.add_argument('--prefetchmem', type=float, default=500, help='Maximum size (Mbytes) of data loaded ahead', metavar='')
+parser.add_argument('--wwsconns', type=int, default=4, help='Maximum number of simultaneous requests to winston wave server', metavar='')
 
 choices=['allZ','all3C','closeZ','close3C','radianZ','radian3C','Z','specialZ', 'spectrumZ', '3C','special3C','irishZ','irish3C','lahar','tfr','forAI', 'rockfall', 'partmot', 'all', 'allplusZ', 'strain', 'strainplus', 'infra', 'infraplus', 'heli', 'longsgram', 'stringthing' ]
-parser.add_argument('-k', '--kind', default='allZ', choices=choices, help='Kind of plot (case-insensitive): '+' | '.join(choices), metavar='')
-parser.add_argument('--sta', default='MSS1', help='Station(s) to be plotted, comma separated) (not used in some kinds of plot).', metavar='')
+kindChoices = choices
+parser.add_argument('-k', '--kind', default='allZ', help='Kind(s) of plot, comma separated (case-insensitive): '+' | '.join(choices), metavar='')
+parser.add_argument('--sta', default='MSS1', help='Station(s) to be plotted, comma separated) (not used in some kinds of plot). Kinds of plot for one station make one plot per station.', metavar='')
 
 parser.add_argument('-d', '--date', default='today', help='Date of event (UTC): today | yesterday | yyyy-mm-dd | yyyy.jjj', metavar='')
 parser.add_argument('-t', '--time', default='now', help='Time of event (UTC): hh:mm | hh:mm:ss | hh:mm:ss.s | now |now-X | now-Xs | now-Xm', metavar='')
@@ -133,15 +162,35 @@ parser.add_argument('rest', nargs=argparse.REMAINDER)
 
 args = parser.parse_args()
 
+if args.layout and args.layout.lower() not in getnPlotLayout.layoutChoices:
+    parser.error( "argument --layout: invalid choice: '" + args.layout + "'" )
+
+plotKinds = args.kind.split(',')
+for kind in plotKinds:
+    if kind.lower() not in [ choice.lower() for choice in kindChoices ]:
+        parser.error( "argument -k/--kind: invalid choice: '" + kind + "'" )
+
 
 
 ############  Assign arguments, parsing if necessary
 runQuiet = args.quiet
 runMode = args.mode
+socketPath = args.socket
+fileBatch = args.batch
+numberJobs = args.jobs
+plotLayout = args.layout.lower()
 dataSource= args.source
 wwsIP = args.wwsip
 wwsPort = args.wwsport
-plotKind = args.kind.lower()
+wwsConnections = args.wwsconns
+useCache = not args.nocache
+cacheDir = args.cachedir
+cacheSize = args.cachesize
+menuTtl = args.menuttl
+chunkHours = args.chunk
+prefetchWindows = args.prefetch
+prefetchMbytes = args.prefetchmem
+plotKind = plotKinds[0].lower()
 dataStation = args.sta
 if plotKind == '3c' and dataStation == 'MSS1':
     dataStation = "MBLY"
@@ -259,8 +308,29 @@ if plotTscale == 'd':
     plotTscale = 's'
 
 
+############  Run as a server, keeping everything loaded between plots
+if runMode == 'serve':
+    # Jobs that follow on from each other have the next windows loaded ahead
+    if prefetchWindows > 0:
+        getnPlotFetch.prefetcher = getnPlotFetch.Prefetcher( None, prefetchWindows, prefetchMbytes )
+    exit( getnPlotServe.serve( socketPath, runQuiet ) )
+
+
+
+############  Run for each event in a file, with all other options passed on
+if fileBatch:
+    argvBatch = getnPlotBatch.argvWithout( sys.argv[1:], [ '--batch', '--jobs' ] )
+    exit( getnPlotBatch.runBatch( fileBatch, argvBatch, windowPre, windowDur, numberJobs, runQuiet,
+                                  prefetchWindows, prefetchMbytes ) )
+
+
+
 ############ Suppress all output if required
-if runQuiet:
+if runQuiet and getnPlotRun.inJob:
+    # Server job, where the server's own output must be left alone; runJob puts the streams back
+    sys.stdout = getnPlotRun.devNull()
+    sys.stderr = getnPlotRun.devNull()
+elif runQuiet:
     fd = os.open('/dev/null',os.O_WRONLY)
     os.dup2(fd,2)
     os.dup2(fd,1)
@@ -329,6 +399,24 @@ datimEnd = UTCDateTime(datimBeg + timedelta(seconds=windowDur))
 
 
 
+############  Several kinds of plot, or stations, from one fetch of data
+# Kinds of plot for one station make a plot for each station given
+kindsOneStation = ['tfr', 'forai', 'specialz', 'spectrumz', 'special3c', 'partmot', 'heli']
+plotCombos = []
+for kind in plotKinds:
+    if kind.lower() in kindsOneStation:
+        for sta in args.sta.split(','):
+            plotCombos.append( (kind, sta) )
+    else:
+        plotCombos.append( (kind, args.sta) )
+
+if len( plotCombos ) > 1 and not plotLayout:
+    argvMany = getnPlotBatch.argvWithout( sys.argv[1:], [ '-k', '--kind', '--sta', '--jobs' ] )
+    argvs = [ argvMany + [ '--kind', kind, '--sta', sta ] for kind, sta in plotCombos ]
+    exit( getnPlotBatch.runMany( argvs, datimBeg, datimEnd, numberJobs, runQuiet ) )
+
+
+
 ############  Plot sizes
 if plotShape == "portrait":
     plotSize2 = (int(plotSize/1.5), plotSize)
@@ -367,50 +455,7 @@ if plotKind =='forai' and dataStation == 'MSS1':
 
 
 ############  Channels wanted for all plot types
-nslcWant = {
-    'MV.MBBY.00.HH1', 'MV.MBBY.00.HH2', 'MV.MBBY.00.HHZ',
-    'MV.MBBY..BHE', 'MV.MBBY..BHN', 'MV.MBBY..BHZ',
-    'MV.MBFL.00.HH1', 'MV.MBFL.00.HH2', 'MV.MBFL.00.HHZ',
-    'MV.MBFL..BHE', 'MV.MBFL..BHN', 'MV.MBFL..BHZ',
-    'MV.MBFL..SHZ',
-    'MV.MBFL.00.HDF',
-    'MV.MBFR.00.HH1', 'MV.MBFR.00.HH2', 'MV.MBFR.00.HHZ',
-    'MV.MBFR..BHE', 'MV.MBFR..BHN', 'MV.MBFR..BHZ',
-    'MV.MBGA..SHZ',
-    'MV.MBGB.00.HH1', 'MV.MBGB.00.HH2', 'MV.MBGB.00.HHZ',
-    'MV.MBGB..BHE', 'MV.MBGB..BHN', 'MV.MBGB..BHZ',
-    'MV.MBGB..SHZ',
-    'MV.MBGH.00.HH1', 'MV.MBGH.00.HH2', 'MV.MBGH.00.HHZ',
-    'MV.MBGH..BHE', 'MV.MBGH..BHN', 'MV.MBGH..BHZ',
-    'MV.MBGH..SHZ',
-    'MV.MBHA.10.HHE', 'MV.MBHA.10.HHN', 'MV.MBHA.10.HHZ',
-    'MV.MBHA..BHE', 'MV.MBHA..BHN', 'MV.MBHA..BHZ',
-    'MV.MBHA..SHZ',
-    'MV.MBLG.00.HH1', 'MV.MBLG.00.HH2', 'MV.MBLG.00.HHZ',
-    'MV.MBLG..BHE', 'MV.MBLG..BHN', 'MV.MBLG..BHZ',
-    'MV.MBLG..SHZ',
-    'MV.MBLY.00.HH1', 'MV.MBLY.00.HH2', 'MV.MBLY.00.HHZ',
-    'MV.MBLY..BHE', 'MV.MBLY..BHN', 'MV.MBLY..BHZ',
-    'MV.MBRV..BHE', 'MV.MBRV..BHN', 'MV.MBRV..BHZ',
-#    'MV.MBRV..SHZ',
-    'MV.MBRY..BHE', 'MV.MBRY..BHN', 'MV.MBRY..BHZ',
-    'MV.MBWH.00.HH1', 'MV.MBWH.00.HH2', 'MV.MBWH.00.HHZ',
-    'MV.MBWH..BHE', 'MV.MBWH..BHN', 'MV.MBWH..BHZ',
-#    'MV.MBWH..SHZ',
-    'MV.MRYT..SHZ',
-    'MV.MSS1..SHZ',
-    'MC.AIRS..BLZ', 'MC.OlV1..BLZ', 'MC.TRNT..BLZ',
-    'CU.GRGR.00.BHZ', 'CU.GRGR.00.BH1', 'CU.GRGR.00.BH2',
-    'CU.ANWB.00.BHZ', 'CU.ANWB.00.BH1', 'CU.ANWB.00.BH2',
-    'CU.BBGH.00.BHZ', 'CU.BBGH.00.BH1', 'CU.BBGH.00.BH2',
-    'WI.ABD.00.HHZ', 'WI.ABD.00.HHN', 'WI.ABD.00.HHE',
-    'WI.DHS.00.HHZ', 'WI.DHS.00.HHN', 'WI.DHS.00.HHE',
-    'NA.SABA..BHZ', 'NA.SABA..BHN', 'NA.SABA..BHE',
-    'TR.SVT..HHZ', 'TR.SVT..HHN', 'TR.SVT..HHE',
-    'TR.DSLB..HHZ', 'TR.DSLB..HHN', 'TR.DSLB..HHE',
-    'MC.OLV1..BHZ', 'MC.OLV1..BHE', 'MC.OLV1..BHN',
-    'MC.TRNT..BHZ', 'MC.TRNT..BHE', 'MC.TRNT..BHN'
-}
+nslcWant = getnPlotChannels.nslcWant
 
 
 
@@ -507,6 +552,10 @@ if chas == '3c' and dataNormalize != 'no':
 
 fileStaTag = '-'.join( ['_'.join( stas ), chas.upper()] )
 
+# Only these channels are fetched
+nslcFetch = getnPlotChannels.nslcForPlot( stas, chas )
+nslcFetchKeys = set( nslc.upper() for nslc in nslcFetch )
+
 numberStations = len( stas )
 
 
@@ -608,6 +657,14 @@ fileMseedOut = filenameSeparator.join([fileMseedOut, 'mseed'])
 fileMseedOut = dirnameSeparator.join([outDir, fileMseedOut])
 
 
+############  Composite plot, made of several plots
+if plotLayout:
+    argvLayout = getnPlotBatch.argvWithout( sys.argv[1:], [ '--layout', '--jobs' ] )
+    exit( getnPlotLayout.runLayout( plotLayout, argvLayout, filePlot, evDatim, datimBeg, datimEnd, windowDur,
+                                    plotHeliWidth, numberJobs, runQuiet ) )
+
+
+
 ############  Values for forAI plot
 if plotKind == "forai":
     #windowPre = 5
@@ -631,8 +688,17 @@ if not runQuiet:
     print(' Source:             ' + dataSource)
     print(' WWS IP:             ' + wwsIP)
     print(' WWS port:           ' + str(wwsPort))
+    print(' WWS connections:    ' + str(wwsConnections))
+    print(' Use cache:          ' + str(useCache))
+    print(' Cache dir:          ' + cacheDir)
+    print(' Cache size (MB):    ' + str(cacheSize))
+    print(' Menu TTL (s):       ' + str(menuTtl))
+    print(' Chunk (hours):      ' + str(chunkHours))
+    print(' Prefetch windows:   ' + str(prefetchWindows))
+    print(' Prefetch size (MB): ' + str(prefetchMbytes))
     print(' Station:            ' + dataStation)
     print(' N stations:         ' + str( numberStations))
+    print(' N channels:         ' + str( len(nslcFetch) ))
     print(' Event date:         ' + eventDate)
     print(' Event time:         ' + eventTime)
     print(' Window pre:         ' + str(windowPre) + ' seconds')
@@ -700,85 +766,111 @@ if runMode == 'test':
 
 
 
+############  Long windows from mseed files are fetched, processed and reduced a chunk at a time
+# Not for plots that need every sample, or processing that needs the whole window
+kindsWhole = ['tfr', 'stringthing', 'forai', 'specialz', 'spectrumz', 'special3c', 'partmot', 'lahar', 'rockfall', 'longsgram']
+dataChunked = ( dataSource == 'mseed' and chunkHours > 0 and windowDur > getnPlotStream.longWindowSeconds
+                and plotKind not in kindsWhole and runMode != 'get' and not ( dataVec or dataTaper or saveRMS ) )
+if plotKind == 'heli':
+    binSeconds = 60 * int( plotHeliWidth ) / ( getnPlotStream.binsPerPixel * plotSize2[0] )
+else:
+    binSeconds = windowDur / ( getnPlotStream.binsPerPixel * plotSize2[0] )
+
+
+
 ############  Get all waveform data for interval
 if not runQuiet:
     print( 'Fetching Data' )
 
 st = Stream()
 
+if useCache:
+    cache = getnPlotCache.sharedBlockCache( cacheDir, cacheSize )
+else:
+    cache = None
+if menuTtl > 0:
+    menuCache = getnPlotCache.sharedMenuCache( cacheDir, menuTtl )
+else:
+    menuCache = None
+sdsIndex = getnPlotSds.sharedSdsIndex( pathMseed, cacheDir )
+
 if dataSource == 'auto':
-    # First try Waveserver
-    dataSource = 'waveserver ' + str(wwsIP)
-    client = Client(wwsIP, wwsPort, clientTimeout)
-    info = client.get_availability(network='*', station='*', channel='*')
-    #info = client.get_availability(network='MV', station='*', channel='*')
-    sys.stdout = open(os.devnull, "w")
-    sys.stderr = open(os.devnull, "w")
-    for net, sta, loc, cha, start, end in info:
-        st += client.get_waveforms(net, sta, loc, cha, datimBeg, datimEnd)
-    sys.stdout = sys.__stdout__
-    sys.stderr = sys.__stderr__
-
-    if len(st) == 0:
-        # Second try miniseed files
-        dataSource = 'continuous miniseed data'
-        warnings.filterwarnings("ignore")
-        for netw in ["MV", "MC", "CU", "TR"]:
-            client = sdsClient(dirnameSeparator.join([pathMseed, netw]))
-            client.FMTSTR = '{station}/{year}.{doy:03d}.{network}.{station}.{location}.{channel}.mseed'
-            st += client.get_waveforms(netw, '*',
-                                           '*', '*', datimBeg, datimEnd)
-        warnings.filterwarnings("default")
+    # Waveserver and miniseed files at once, each channel from whichever has it whole first
+    dataSource = 'waveserver ' + str(wwsIP) + ' and continuous miniseed data'
+    pool = getnPlotFetch.sharedPool(wwsIP, wwsPort, clientTimeout, wwsConnections, menuCache)
+    nslcs = [ nslc.split('.') for nslc in nslcFetch ]
+    stFetched, sourcesNslc = getnPlotFetch.fetchRace( pool, pathMseed, nslcs, datimBeg, datimEnd, cache=cache, index=sdsIndex )
+    st += stFetched
 
     if not runQuiet:
         print(' Streams from ' + dataSource + ': ' + str(len(st)))
+        for nslc in nslcFetch:
+            if sourcesNslc[ nslc.upper() ] != 'none':
+                print(' Source of ' + nslc + ': ' + sourcesNslc[ nslc.upper() ])
+        nslcsNone = [ nslc for nslc in nslcFetch if sourcesNslc[ nslc.upper() ] == 'none' ]
+        if nslcsNone:
+            print(' No data for:        ' + ' '.join( nslcsNone ))
 
 elif dataSource == 'wws':
     # Waveserver
     # Define wave server
-    client = Client(wwsIP, wwsPort, clientTimeout)
-    # Fetch all data from waveserver
-    info = client.get_availability(network='MV', station='M*', channel='*')
-    for net, sta, loc, cha, start, end in info:
-        st += client.get_waveforms(net, sta, loc, cha, datimBeg, datimEnd)
+    pool = getnPlotFetch.sharedPool(wwsIP, wwsPort, clientTimeout, wwsConnections, menuCache)
+    # Fetch wanted data from waveserver
+    info = pool.getAvailability(network='MV', station='M*', channel='*')
+    info = getnPlotFetch.availableInWindow( info, datimBeg, datimEnd, pool.menuAge )
+    nslcs = [ (net, sta, loc, cha) for net, sta, loc, cha, start, end in info
+             if getnPlotChannels.nslcKey( net, sta, loc, cha ) in nslcFetchKeys ]
+    st += getnPlotFetch.fetchWaveserver( pool, nslcs, datimBeg, datimEnd, cache=cache )
+
+elif dataSource == "mseed" and dataChunked:
+    nslcs = [ nslc.split('.') for nslc in nslcFetch ]
+    # Next chunks are read while this one is processed
+    with getnPlotFetch.prefetching( getnPlotStream.chunkWindows( datimBeg, datimEnd, 3600 * chunkHours ),
+                                    prefetchWindows, prefetchMbytes ):
+        st += getnPlotStream.reduceChunks(
+            lambda beg, end: getnPlotFetch.fetchSds( pathMseed, nslcs, beg, end, index=sdsIndex ),
+            datimBeg, datimEnd, binSeconds, 3600 * chunkHours,
+            getnPlotStream.ChunkProcessor( dataLPfilt, dataHPfilt, dataIntegrate, dataDownsample,
+                                           dataAbs, dataSqrt, dataLog, dataEnv ),
+            runQuiet )
 
 elif dataSource == "mseed":
-    client = sdsClient(pathMseed)
-    client.FMTSTR = '{network}/{station}/{year}.{doy:03d}.{network}.{station}.{location}.{channel}.mseed'
-    st = client.get_waveforms('*', '*', '*', '*', datimBeg, datimEnd)
+    nslcs = [ nslc.split('.') for nslc in nslcFetch ]
+    st += getnPlotFetch.fetchSds( pathMseed, nslcs, datimBeg, datimEnd, cache=cache, index=sdsIndex )
 
 elif dataSource == "cont":
-    command = 'findWavGet ' + eventDate + ' ' + eventTime + ' ' + str( int(windowDur/60.0) )
+    # Continuous files covering the window, read and merged here
+    st, filesCont = getnPlotFetch.fetchCont( datimBeg, datimEnd )
     if not runQuiet:
-        print( command )
-    dataSource = subprocess.check_output( command, shell=True, text=True )
-    dataSource = dataSource.rstrip()
-    if os.path.isfile(dataSource):
-        if not runQuiet:
-            print(' Data file.: ' + dataSource)
-        st = obspy.read(dataSource)
+        for fileCont in filesCont:
+            print(' Data file.: ' + fileCont)
 
 elif dataSource == "event":
+    # Event files with data at the event time, from the index of WAV/MVOE_
+    eventIndex = getnPlotEvents.sharedEventIndex( pathWAV1, cacheDir )
+    filesEvent = eventIndex.covering( UTCDateTime(evDatim) )
     if not runQuiet:
-        print( ' Source ' + dataSource + ' not implemented' )
+        print( ' Event files:        ' + str( len(filesEvent) ) )
+    for fileEvent in filesEvent:
+        if not runQuiet:
+            print(' Data file.: ' + fileEvent)
+        st += obspy.read(fileEvent)
+    if len(filesEvent) > 1:
+        st.merge( method=-1 )
 
 else:
     # Event file
     if not os.path.isfile(dataSource):
         if not runQuiet:
             print(' No file in local directory')
-        # If file doesnt exist, search in WAV/MVOE_ or WAV/ROD__
-        try:
-            dataSource = find(dataSource, pathWAV1)
-        except:
+        # If file doesnt exist, look it up in the index of WAV/MVOE_
+        eventIndex = getnPlotEvents.sharedEventIndex( pathWAV1, cacheDir )
+        fileEvent = eventIndex.lookup( os.path.basename(dataSource) )
+        if fileEvent is None:
             if not runQuiet:
                 print(' No file in', pathWAV1)
             exit(0)
-            #try:
-            #    dataSource = find(dataSource, pathWAV2)
-            #except:
-            #    print('  No file in', pathWAV2)
-            #    exit(0)
+        dataSource = fileEvent
     if os.path.isfile(dataSource):
         if not runQuiet:
             print(' Data file.: ' + dataSource)
@@ -788,6 +880,12 @@ else:
 
 
 
+############  Stop here when only fetching data for other plots
+if getnPlotRun.fetchOnly:
+    exit(0)
+
+
+
 ############  Bug out if nothing got
 if len(st) == 0:
     if not runQuiet:
@@ -820,73 +918,29 @@ if chunks[0] == "":
 
 ############  Extract time window
 st.trim(starttime=datimBeg, endtime=datimEnd)
-stWant = Stream()
-for idWant in nslcWant:
-    stWant += st.select(id=idWant)
-#nslc = set(tr.id for tr in stWant)
-#print( nslc )
+# One trace for each channel, with gaps masked
+st = getnPlotBlock.mergeStream( st )
+# Wanted channels, indexed by channel and station
+channelIndex = getnPlotChannels.ChannelIndex( st, set( nslc.upper() for nslc in nslcWant ) )
 
 
 
 ############  Create stream with only the wanted channels
 st2 = Stream()
 icha = 0
-if chas == "z":
+if chas in ( "z", "h", "hz" ):
     # Loop round wanted stations
     for sta in stas:
         icha += 1
         # Get wanted channels
-        try:
-            stt = stWant.select(station=sta, component=chas)
-            tr = stt[0]
-        except:
-            tr = Trace(data=np.zeros(2))
-            tr.stats.npts = 2
-            tr.stats.starttime = datimBeg
-            tr.stats.station = sta
-            tr.stats.sampling_rate = 100.0
-        netf = f'{icha:02d}'
-        tr.stats.network = netf
-        st2 += tr
-elif chas == "h":
-    # Loop round wanted stations
-    for sta in stas:
-        icha += 1
-        # Get wanted channels
-        try:
-            stt = stWant.select(station=sta, channel='HDF')
-            tr = stt[0]
-        except:
-            tr = Trace(data=np.zeros(2))
-            tr.stats.npts = 2
-            tr.stats.starttime = datimBeg
-            tr.stats.station = sta
-            tr.stats.sampling_rate = 100.0
-        netf = f'{icha:02d}'
-        tr.stats.network = netf
-        st2 += tr
-elif chas == "hz":
-    # Loop round wanted stations
-    for sta in stas:
-        icha += 1
-        # Get wanted channels
-        try:
-            stt = stWant.select(station=sta, component='z')
-            tr = stt[0]
-        except:
-            tr = Trace(data=np.zeros(2))
-            tr.stats.npts = 2
-            tr.stats.starttime = datimBeg
-            tr.stats.station = sta
-            tr.stats.sampling_rate = 100.0
-        netf = f'{icha:02d}'
-        tr.stats.network = netf
-        st2 += tr
-        if sta == 'MBFL':
-            try:
-                stt = stWant.select(station=sta, channel='HDF')
-                tr = stt[0]
-            except:
+        if chas == "h":
+            trs = [ channelIndex.first( sta, channel='HDF' ) ]
+        else:
+            trs = [ channelIndex.first( sta, component='z' ) ]
+        if chas == "hz" and sta == 'MBFL':
+            trs.append( channelIndex.first( sta, channel='HDF' ) )
+        for tr in trs:
+            if tr is None:
                 tr = Trace(data=np.zeros(2))
                 tr.stats.npts = 2
                 tr.stats.starttime = datimBeg
@@ -895,98 +949,16 @@ elif chas == "hz":
             netf = f'{icha:02d}'
             tr.stats.network = netf
             st2 += tr
-elif chas == "3c":
-    # Loop round wanted stations
+elif chas in ( "3c", "all" ):
+    # Loop round wanted stations, taking HH, then BH, then SH (then BL for 3c) channels
+    bands = getnPlotChannels.bandsPrefer3c if chas == "3c" else getnPlotChannels.bandsPreferAll
     for sta in stas:
-        stt = stWant.select(station=sta, channel='HH*')
-        if len(stt) == 3:
-            for i in range(3):
-                tr = stt[i]
-                if tr.stats.channel.endswith('Z'):
-                    ichat = icha + 1
-                elif tr.stats.channel.endswith('1'):
-                    ichat = icha + 2
-                elif tr.stats.channel.endswith('2'):
-                    ichat = icha + 3
-                elif tr.stats.channel.endswith('E'):
-                    ichat = icha + 2
-                elif tr.stats.channel.endswith('N'):
-                    ichat = icha + 3
-                netf = f'{ichat:02d}'
-                tr.stats.network = netf
-                st2 += tr
-            icha += 3
-        else:
-            stt = stWant.select(station=sta, channel='BH*')
-            if len(stt) == 3:
-                for i in range(3):
-                    tr = stt[i]
-                    if tr.stats.channel.endswith('Z'):
-                        ichat = icha + 1
-                    elif tr.stats.channel.endswith('E'):
-                        ichat = icha + 2
-                    elif tr.stats.channel.endswith('N'):
-                        ichat = icha + 3
-                    netf = f'{ichat:02d}'
-                    tr.stats.network = netf
-                    st2 += tr
-                icha += 3
-            else:
-                stt = stWant.select(station=sta, channel='SHZ')
-                if len(stt) == 1:
-                    tr = stt[0]
-                    icha += 1
-                    netf = f'{icha:02d}'
-                    tr.stats.network = netf
-                    st2 += tr
-                else:
-                    stt = stWant.select(station=sta, channel='BLZ')
-                    if len(stt) == 1:
-                        tr = stt[0]
-                        icha += 1
-                        netf = f'{icha:02d}'
-                        tr.stats.network = netf
-                        st2 += tr
-elif chas == "all":
-    # Loop round wanted stations
-    for sta in stas:
-        stt = stWant.select(station=sta, channel='HH*')
-        if len(stt) == 3:
-            for i in range(3):
-                tr = stt[i]
-                if tr.stats.channel.endswith('Z'):
-                    ichat = icha + 1
-                elif tr.stats.channel.endswith('1'):
-                    ichat = icha + 2
-                elif tr.stats.channel.endswith('2'):
-                    ichat = icha + 3
-                netf = f'{ichat:02d}'
-                tr.stats.network = netf
-                st2 += tr
-            icha += 3
-        else:
-            stt = stWant.select(station=sta, channel='BH*')
-            if len(stt) == 3:
-                for i in range(3):
-                    tr = stt[i]
-                    if tr.stats.channel.endswith('Z'):
-                        ichat = icha + 1
-                    elif tr.stats.channel.endswith('E'):
-                        ichat = icha + 2
-                    elif tr.stats.channel.endswith('N'):
-                        ichat = icha + 3
-                    netf = f'{ichat:02d}'
-                    tr.stats.network = netf
-                    st2 += tr
-                icha += 3
-            else:
-                stt = stWant.select(station=sta, channel='SHZ')
-                if len(stt) == 1:
-                    tr = stt[0]
-                    icha += 1
-                    netf = f'{icha:02d}'
-                    tr.stats.network = netf
-                    st2 += tr
+        slotted = channelIndex.preferred( sta, bands )
+        for slot, tr in slotted:
+            netf = f'{icha + slot:02d}'
+            tr.stats.network = netf
+            st2 += tr
+        icha += 3 if len( slotted ) == 3 else len( slotted )
 
 
 if not runQuiet:
@@ -995,53 +967,34 @@ if not runQuiet:
 
 
 ############  Process data
-# Deal with overlaps etc
-#st2.merge(method=1)
-# Detrend
+# Overlaps and gaps were dealt with by merging after the time window was extracted.
+# Long windows were processed as they were read
 if not runQuiet:
     print( 'Processing Data' )
 
-st2.detrend('demean')
-if dataLPfilt > 0.0:
-    st2.filter("lowpass", freq=dataLPfilt)
-st2.detrend('demean')
-if dataHPfilt > 0.0:
-    st2.filter("highpass", freq=dataHPfilt)
-if dataIntegrate:
-    st2.filter( "bandpass", freqmax=0.1, freqmin=0.003 )
-    st2.integrate
-if dataDownsample > 1:
-    st2.decimate(factor=dataDownsample, strict_length=False)
-st2.detrend('demean')
-if dataVec:
-    st2 = rodsPythonThings.streamFiddle3C( st2, 'vec' )
-if dataAbs:
-    st2 = rodsPythonThings.streamFiddle( st2, 'abs' )
-if dataSqrt:
-    st2 = rodsPythonThings.streamFiddle( st2, 'sqrt' )
-if dataLog:
-    st2 = rodsPythonThings.streamFiddle( st2, 'log' )
-if dataEnv:
-    st2 = rodsPythonThings.streamFiddle( st2, 'env' )
-if dataTaper:
-    st2 = rodsPythonThings.streamFiddle( st2, 'taper' )
+if not dataChunked:
+    st2 = getnPlotStream.processStream( st2, dataLPfilt, dataHPfilt, dataIntegrate, dataDownsample, dataVec,
+                                        dataAbs, dataSqrt, dataLog, dataEnv, dataTaper, numberJobs )
 
 
 
 ############ Print data range for each channel 
 if printDataRange:
     for trace in st2:
-        dataMax = max( trace.data )
-        dataMin = min( trace.data )
+        dataMax = trace.data.max()
+        dataMin = trace.data.min()
         print(" data range: %4s %3s    min: %12.5f   max: %12.5f" % (trace.stats.station, trace.stats.channel,dataMax, dataMin))
 
 
 ############  Save data as miniseed and exit
 if runMode== "get":
+    # Gaps can not be written
+    st2 = st2.split()
     for trace in st2:
         trace.data = trace.data.astype(np.int32)
         trace.stats.network = "MV"
     st2.write( fileMseedOut, "MSEED" )
+    getnPlotRun.addOutput( fileMseedOut )
     exit(0)
 
 
@@ -1049,11 +1002,14 @@ if runMode== "get":
 ############  Save RMS of each channel in text file
 if saveRMS:
     fileRMS = ''.join([ datimEventString, '--', filenameTag, '--rms.txt' ])
+    getnPlotRun.addOutput( fileRMS )
     fileRMS = open(fileRMS, "w")
     nTrace = len(st2)
     for itr in range(nTrace):
         tr = st2[itr]
-        dataRMS = np.sqrt( np.mean( np.square( tr.detrend("demean") ) ) )
+        # Demean, allowing for gaps
+        tr.data = tr.data - tr.data.mean()
+        dataRMS = np.sqrt( np.mean( np.square( tr.data ) ) )
         fileRMS.write( ' '.join([ evDatim.strftime("%Y-%m-%d %H:%M:%S.%f")[:-5], tr.stats.station, tr.stats.channel, str(dataRMS), "\n"]) )
     fileRMS.close()
 
@@ -1061,11 +1017,12 @@ if saveRMS:
 ############  Save maximum of each channel in text file
 if saveMax:
     fileMax = ''.join([ datimEventString, '--', filenameTag, '--max.txt' ])
+    getnPlotRun.addOutput( fileMax )
     fileMax = open(fileMax, "w")
     nTrace = len(st2)
     for itr in range(nTrace):
         tr = st2[itr]
-        dataMax = max( tr.data )
+        dataMax = tr.data.max()
         fileMax.write( ' '.join([ evDatim.strftime("%Y-%m-%d %H:%M:%S.%f")[:-5], tr.stats.station, tr.stats.channel, str(dataMax), "\n"]) )
     fileMax.close()
 
@@ -1077,13 +1034,9 @@ if plotKind == "heli":
 if dataNormalize == 'yes':
     equalScale = True
 elif dataNormalize == '3c':
-    sttemp = Stream()
-    for sta in stas:
-        sttemp2 = st2.select( station=sta )
-        if len(sttemp2) > 0:
-            sttemp2.normalize( global_max=True )
-            sttemp += sttemp2
-    st2 = sttemp
+    # Each station scaled by its largest value, all channels at once
+    blocks = getnPlotBlock.blocksFromStream( st2 )
+    st2 = getnPlotBlock.streamFromBlocks( getnPlotBlock.normalizeStations( blocks ), split=True )
     equalScale = True
 else:
     equalScale = False
@@ -1136,6 +1089,7 @@ elif plotKind == "lahar":
     thisFig = rodsPythonThings.plotLahar( st2, windowPre, plotRms, plotFscale, plotZscale, plotFmin, plotFmax )
     plotFuncs = 'rods'
     thisFig.set_size_inches(plotSize2[0]/100.0, plotSize2[1]/100.0)
+    getnPlotDraw.decimateLines( thisFig )
 
 elif plotKind == "rockfall":
     thisFig = rodsPythonThings.plotRockfall( st2, windowPre, datimEventString )
@@ -1143,40 +1097,28 @@ elif plotKind == "rockfall":
 
 elif plotKind == "heli":
     sta = stas[0]
-    if plotHeliScale > 0:
-        plotHeliScale = 1.0 / plotHeliScale
-        if sta == 'MSS1':
-            plotHeliScale = plotHeliScale * 1500
-        elif sta == 'MBHA':
-            plotHeliScale = plotHeliScale * 500
-        elif sta == 'MBLG':
-            plotHeliScale = plotHeliScale * 10000
-        elif sta == 'MBLY':
-            plotHeliScale = plotHeliScale * 10000
-        elif sta == 'MBRV':
-            plotHeliScale = plotHeliScale * 2500
-        elif sta == 'MBRY':
-            plotHeliScale = plotHeliScale * 5000
-        else:
-            plotHeliScale = plotHeliScale * 10000
+    plotHeliScale = getnPlotDraw.heliScalingRange( sta, plotHeliScale )
 
-    thisFig = st2.plot( type='dayplot', 
-                       interval = int( plotHeliWidth ),
-                       right_vertical_labels=False,
-                       one_tick_per_line=False,
+    # Drawn from the minimum and maximum in each pixel, so any length of window is quick.
+    # Each channel is already one trace, with any gaps masked, so the long trace is drawn as it is.
+    thisFig = getnPlotDraw.heliFigure( st2.select( id=st2[0].id )[0], datimBeg, datimEnd,
+                       interval = 60 * int( plotHeliWidth ),
                        size=plotSize2,
-                       vertical_scaling_range=plotHeliScale,
-                       show=False,
-                       tick_format='%H:%M',
-                       color=['k','r','b','g'],
-                       linewidth=plotLineWidth)
+                       scalingRange=plotHeliScale,
+                       colors=['k','r','b','g'],
+                       linewidth=plotLineWidth,
+                       tickFormat='%H:%M' )
 
 else:
+    # Long windows are drawn from the minimum and maximum in each pixel
+    plotMethod = getnPlotDraw.plotMethod( st2, plotSize2[0], datimBeg, datimEnd )
+    if plotMethod == 'fast':
+        st2 = getnPlotDraw.splitMasked( st2 )
     if plotGrid:
-        thisFig = st2.plot(starttime=datimBeg, endtime=datimEnd,
+        thisFig = st2.plot(starttime=datimBeg, endtime=datimEnd, method=plotMethod,
                        equal_scale=equalScale, linewidth=plotLineWidth, show=False, size=plotSize2)
     else:
-        thisFig = st2.plot(starttime=datimBeg, endtime=datimEnd,
+        thisFig = st2.plot(starttime=datimBeg, endtime=datimEnd, method=plotMethod,
                        equal_scale=equalScale, linewidth=plotLineWidth, show=False, size=plotSize2)
 
 
@@ -1255,12 +1197,17 @@ if plotFuncs == 'obspy' and plotYlim> 0:
 ############  Save plot as png
 if not runQuiet:
     print(' Plot file: ' + filePlot)
-thisFig.savefig(filePlot)
+if getnPlotRun.figureSink is not None:
+    # Panel of a composite plot
+    getnPlotRun.figureSink( thisFig, filePlot )
+else:
+    thisFig.savefig(filePlot)
+    getnPlotRun.addOutput( filePlot )
 
 
 
 ############  Show plot on screen
-if plotShow:
+if plotShow and getnPlotRun.figureSink is None:
     #thisFig.show()
     subprocess.Popen([ "eog", filePlot ],
         stdout=subprocess.DEVNULL,
@@ -1275,10 +1222,3 @@ endTime = datetime.now()
 elapsed = endTime - startTime
 print( "Elapsed time: ", elapsed )
 
-
-
-############  find: Function to recursively search for a file and return the full path
-def find(name, path):
-    for root, dirs, files in os.walk(path):
-        if name in files:
-            return os.path.join(root, name)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# getnPlotBatch.py
+#
+# Batch mode of getnPlot.py (--batch FILE): one plot for each event in a list,
+# all from the same python process instead of one getnPlot per event.
+# Also used for several kinds of plot, or stations, of one event (--kind tfr,allZ).
+#
+# Events are sorted by time and those with overlapping or adjacent windows are grouped,
+# so data for each group is fetched once.  Groups are only split when too long to hold
+# in memory.  Groups are plotted in parallel by a pool of processes; a group with many
+# events is fetched first, then its events are shared out among the processes.
+#
+# Event list formats read:
+#   yyyy-mm-dd hh:mm:ss [duration] [tag]   as used by getnPlotVtse2 and getnPlotWav,
+#                                          duration in minutes, 0 for the --dur option
+#   yyyy mm dd hh mm ss                    as used by vtst2getnp.pl
+#   Nordic (seisan select.out)             as used by select2getnp.pl, tag from VOLC MAIN
+#
+
+
+
+############  Imports
+import math
+import multiprocessing
+from datetime import timedelta
+from dateutil import parser as dparser
+from obspy.core import UTCDateTime
+
+import getnPlotFetch
+import getnPlotRun
+
+
+
+############  Constants
+chunkSecondsMax = 3600
+volcTags = { 't': 'VT', 'l': 'LP', 'h': 'Hybrid', 'r': 'Rockfall', 'e': 'LP_rockfall',
+             'x': 'Explosion', 's': 'Swarm', 'n': 'Noise', 'm': 'Monochromatic' }
+typeTags = { 'L': 'Local', 'R': 'Regional', 'D': 'Distant' }
+
+
+
+############  readEvents: Function to read an event list, returning (date, time, minutes, tag) for each event
+def readEvents( fileBatch ):
+
+    with open( fileBatch, encoding='utf-8', errors='replace' ) as fileIn:
+        lines = fileIn.read().splitlines()
+
+    if any( len( line ) >= 80 and line[79] == '1' for line in lines ):
+        return _readNordic( lines )
+
+    events = []
+    for line in lines:
+        bits = line.split()
+        if not bits or not bits[0].startswith( '2' ):
+            continue
+        if len( bits ) >= 6 and '-' not in bits[0] and ':' not in bits[3]:
+            # yyyy mm dd hh mm ss
+            events.append( ( '-'.join( bits[0:3] ), ':'.join( bits[3:6] ), 0.0, '' ) )
+            continue
+        if len( bits ) < 2:
+            continue
+        minutes = 0.0
+        if len( bits ) > 2:
+            try:
+                minutes = float( bits[2] )
+            except ValueError:
+                minutes = 0.0
+        tag = ''
+        if len( bits ) > 3:
+            tag = bits[3]
+        events.append( ( bits[0], bits[1], minutes, tag ) )
+
+    return events
+
+
+
+############  _readNordic: Function to read events from type 1 and VOLC MAIN lines of a Nordic file
+def _readNordic( lines ):
+
+    events = []
+    evDate = ''
+    for line in lines + [ '' ]:
+        if len( line ) >= 80 and line[79] == '1':
+            # Only the first type 1 line of an event is its main solution
+            if evDate:
+                continue
+            evDate = '-'.join([ line[1:5], line[6:8].replace( ' ', '0' ), line[8:10].replace( ' ', '0' ) ])
+            evTime = ':'.join([ line[11:13].replace( ' ', '0' ), line[13:15].replace( ' ', '0' ),
+                                line[16:20].replace( ' ', '0' ) ])
+            evTag = typeTags.get( line[21:23].strip(), '' )
+        elif len( line ) >= 80 and line[79] == '3' and line[1:10] == 'VOLC MAIN':
+            evTag = volcTags.get( line[11], evTag )
+        elif not line.strip() and evDate:
+            events.append( ( evDate, evTime, 0.0, evTag ) )
+            evDate = ''
+
+    return events
+
+
+
+############  eventDatim: Function to turn date and time strings into UTCDateTime, as getnPlot.py does
+def eventDatim( eventDate, eventTime ):
+
+    evDate = dparser.parse( eventDate )
+    if eventTime.count(':') == 1:
+        [hours, minutes] = [float(x) for x in eventTime.split(':')]
+        seconds = 0.0
+    else:
+        [hours, minutes, seconds] = [float(x) for x in eventTime.split(':')]
+
+    return UTCDateTime( evDate + timedelta(hours=hours, minutes=minutes, seconds=seconds) )
+
+
+
+############  chunkEvents: Function to group events with overlapping windows, splitting groups too long to hold in memory
+def chunkEvents( events, windowPre, windowDur ):
+    # Returns list of (starttime, endtime, events) in time order
+
+    windows = []
+    for event in events:
+        eventDate, eventTime, minutes, tag = event
+        try:
+            datim = eventDatim( eventDate, eventTime )
+        except ( ValueError, OverflowError ):
+            continue
+        dur = windowDur
+        if minutes > 0:
+            dur = 60 * minutes
+        windows.append( ( datim - windowPre, datim - windowPre + dur, event ) )
+    windows.sort( key=lambda x: x[0] )
+
+    # Overlapping or adjacent windows
+    groups = []
+    for beg, end, event in windows:
+        if groups and beg <= groups[-1][-1][1]:
+            groups[-1].append( (beg, max( end, groups[-1][-1][1] ), event) )
+        else:
+            groups.append( [ (beg, end, event) ] )
+
+    chunks = []
+    for group in groups:
+        chunk = []
+        for beg, end, event in group:
+            if chunk and end - chunk[0][0] > chunkSecondsMax:
+                chunks.append( chunk )
+                chunk = []
+            chunk.append( (beg, end, event) )
+        chunks.append( chunk )
+
+    return [ ( chunk[0][0], max( end for beg, end, event in chunk ), [ event for beg, end, event in chunk ] )
+             for chunk in chunks ]
+
+
+
+############  eventArgv: Function to return getnPlot arguments for one event
+def eventArgv( argv, event ):
+
+    eventDate, eventTime, minutes, tag = event
+    argvEvent = list( argv )
+    if minutes > 0:
+        argvEvent += [ '--dur', str( minutes ) + 'm' ]
+    if tag:
+        argvEvent += [ '--tag', tag ]
+    argvEvent += [ '--date', eventDate, '--time', eventTime ]
+
+    return argvEvent
+
+
+
+############  argvWithout: Function to remove options, with their values, from a list of arguments
+def argvWithout( argv, options ):
+
+    argvOut = []
+    iarg = 0
+    while iarg < len( argv ):
+        arg = argv[iarg]
+        if arg in options:
+            iarg += 2
+            continue
+        if not any( arg.startswith( option + '=' ) for option in options if option.startswith( '--' ) ):
+            argvOut.append( arg )
+        iarg += 1
+
+    return argvOut
+
+
+
+############  _runChunk: Function to plot the events of one chunk, sharing the data for its window
+def _runChunk( task ):
+
+    argv, ( starttime, endtime, events ) = task
+
+    # A window already fetched for the whole group is used as it is
+    shared = getnPlotFetch.sharedWindow is None or not getnPlotFetch.sharedWindow.covers( starttime, endtime )
+    if shared:
+        getnPlotFetch.sharedWindow = getnPlotFetch.SharedWindow( starttime, endtime )
+    results = []
+    try:
+        for event in events:
+            argvEvent = eventArgv( argv, event )
+            status, files, output = getnPlotRun.runJob( argvEvent + [ '--quiet' ] )
+            results.append( ( argvEvent, status, files, output ) )
+    finally:
+        if shared:
+            getnPlotFetch.sharedWindow = None
+
+    return results
+
+
+
+############  runBatch: Function to plot all events in a list, returning exit status
+def runBatch( fileBatch, argv, windowPre, windowDur, jobs=1, runQuiet=False, prefetchWindows=2, prefetchMbytes=500 ):
+
+    try:
+        events = readEvents( fileBatch )
+    except OSError as exc:
+        print( 'Could not read batch file: ' + str( exc ) )
+        return 1
+
+    jobs = max( 1, int( jobs ) )
+    chunks = chunkEvents( events, windowPre, windowDur )
+    nEvents = sum( len( chunk[2] ) for chunk in chunks )
+    if not runQuiet:
+        print( 'Batch file:         ' + fileBatch )
+        print( ' Events:            ' + str( nEvents ) )
+        print( ' Fetch windows:     ' + str( len( chunks ) ) )
+        print( ' Jobs:              ' + str( min( jobs, max( 1, nEvents ) ) ) )
+
+    if jobs == 1 or nEvents <= 1:
+        # Windows of the next chunks are read while this one is plotted
+        tasks = [ ( argv, chunk ) for chunk in chunks ]
+        with getnPlotFetch.prefetching( [ ( starttime, endtime ) for starttime, endtime, events in chunks ],
+                                        prefetchWindows, prefetchMbytes ):
+            return _runTasks( _runChunk, tasks, 1, runQuiet )
+
+    # Processes each fetch their own windows, except those with more events than keep all processes
+    # busy, which are fetched here once and then shared out.  Plots are still reported in time order.
+    eventsPerChunk = max( 1, math.ceil( nEvents / ( 2 * jobs ) ) )
+    status = 0
+    tasks = []
+    for chunk in chunks:
+        if len( chunk[2] ) <= eventsPerChunk:
+            tasks.append( ( argv, chunk ) )
+            continue
+        status |= _runTasks( _runChunk, tasks, jobs, runQuiet )
+        tasks = []
+        status |= _runGroup( argv, chunk, eventsPerChunk, jobs, runQuiet )
+    status |= _runTasks( _runChunk, tasks, jobs, runQuiet )
+
+    return status
+
+
+
+############  _runGroup: Function to fetch the window of a group of events once, then plot its events in parallel
+def _runGroup( argv, chunk, eventsPerChunk, jobs, runQuiet ):
+
+    starttime, endtime, events = chunk
+    getnPlotFetch.sharedWindow = getnPlotFetch.SharedWindow( starttime, endtime )
+    try:
+        prefetch([ eventArgv( argv, events[0] ) ])
+        tasks = [ ( argv, ( starttime, endtime, events[ievent:ievent+eventsPerChunk] ) )
+                  for ievent in range( 0, len( events ), eventsPerChunk ) ]
+        status = _runTasks( _runChunk, tasks, jobs, runQuiet )
+    finally:
+        getnPlotFetch.sharedWindow = None
+
+    return status
+
+
+
+############  runMany: Function to make several plots of the same window, fetching the data for all of them once
+def runMany( argvs, starttime, endtime, jobs=1, runQuiet=False ):
+
+    jobs = max( 1, int( jobs ) )
+    if not runQuiet:
+        print( 'Plots:              ' + str( len( argvs ) ) )
+        print( ' Jobs:              ' + str( min( jobs, len( argvs ) ) ) )
+
+    # A window already fetched by a batch is used as it is
+    shared = getnPlotFetch.sharedWindow is None or not getnPlotFetch.sharedWindow.covers( starttime, endtime )
+    if shared:
+        getnPlotFetch.sharedWindow = getnPlotFetch.SharedWindow( starttime, endtime )
+    try:
+        if jobs > 1 and len( argvs ) > 1:
+            prefetch( argvs )
+        tasks = [ ( argv, ) for argv in argvs ]
+        status = _runTasks( _runPlot, tasks, jobs, runQuiet )
+    finally:
+        if shared:
+            getnPlotFetch.sharedWindow = None
+
+    return status
+
+
+
+############  prefetch: Function to fetch the channels of several plots into the shared window, so forked processes all start with them
+def prefetch( argvs ):
+
+    getnPlotRun.fetchOnly = True
+    try:
+        for argv in argvs:
+            getnPlotRun.runJob( argv + [ '--quiet' ] )
+    finally:
+        getnPlotRun.fetchOnly = False
+
+
+
+############  _runPlot: Function to make one plot, for runMany
+def _runPlot( task ):
+
+    argv, = task
+    status, files, output = getnPlotRun.runJob( argv + [ '--quiet' ] )
+
+    return [ ( argv, status, files, output ) ]
+
+
+
+############  _initProcess: Function run at the start of each forked process
+def _initProcess():
+
+    # Wave server connections and prefetch threads belong to the parent
+    getnPlotFetch.pools.clear()
+    getnPlotFetch.prefetcher = None
+
+
+
+############  mapJobs: Function to run tasks in a pool of forked processes, or here if only one job, yielding results in order
+def mapJobs( func, tasks, jobs ):
+
+    # Processes of a pool cannot have pools of their own, so batch events and layout panels run here
+    if jobs == 1 or len( tasks ) <= 1 or multiprocessing.current_process().daemon:
+        yield from map( func, tasks )
+        return
+
+    # Forked processes start with everything already imported
+    pool = multiprocessing.get_context( 'fork' ).Pool( min( jobs, len( tasks ) ), _initProcess )
+    try:
+        yield from pool.imap( func, tasks )
+    finally:
+        pool.close()
+        pool.join()
+
+
+
+############  _runTasks: Function to run tasks and report their plots, returning exit status
+def _runTasks( func, tasks, jobs, runQuiet ):
+
+    status = 0
+    for results in mapJobs( func, tasks, jobs ):
+        for argvJob, statusJob, files, output in results:
+            if statusJob != 0:
+                status = 1
+            for fileOut in files:
+                getnPlotRun.addOutput( fileOut )
+            if not runQuiet:
+                print( 'getnPlot ' + ' '.join( argvJob ) )
+                for fileOut in files:
+                    print( '  ' + fileOut )
+                if statusJob != 0:
+                    print( '  Failed (' + str( statusJob ) + ')' )
+                    print( output.rstrip() )
+
+    return status
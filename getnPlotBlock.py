@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# getnPlotBlock.py
+#
+# Channels of a window held as one array, for getnPlot.py
+#
+# A ChannelBlock holds channels with the same sampling rate as the rows of one 2-D
+# array on a shared time base, with the codes of each row and a mask of samples with
+# no data.  Operations across channels, such as scaling each station by its largest
+# value, are then done on the whole array at once instead of trace by trace.
+#
+# A stream with channels at several rates becomes one block for each rate, and the
+# blocks turn back into a stream with its traces in the order they started in.
+# Start times of traces are rounded to the nearest sample of the block.
+#
+# The pieces of a channel, as the wave server returns them, are merged the same
+# way: each is copied once into an array for the whole channel, with gaps masked.
+#
+
+
+
+############  Imports
+import numpy as np
+from obspy.core import UTCDateTime, Stream, Trace
+
+
+
+############  ChannelBlock: Class holding equal rate channels as rows of one array
+class ChannelBlock:
+
+    __slots__ = ( 'data', 'mask', 'starttime', 'delta', 'stats', 'positions' )
+
+    def __init__( self, data, starttime, delta, stats, mask=None, positions=None ):
+        # data has a row for each channel, stats the header of each row.
+        # mask is True where there is no data, None if there are no gaps.
+        # positions are where each row came in the stream it was made from.
+
+        self.data = data
+        self.mask = mask
+        self.starttime = UTCDateTime( starttime )
+        self.delta = float( delta )
+        self.stats = stats
+        self.positions = positions if positions is not None else list( range( len( stats ) ) )
+
+    @classmethod
+    def fromStream( cls, st, starttime=None, endtime=None, dtype=np.float64 ):
+        # Block of a stream whose traces all have the same sampling rate, over the window
+        # given or the span of the traces.  Traces of the same channel share a row.
+
+        if len( st ) == 0:
+            raise ValueError( 'No traces for block' )
+        delta = st[0].stats.delta
+        for tr in st:
+            if abs( tr.stats.delta - delta ) > 1e-9 * delta:
+                raise ValueError( 'Traces for block differ in sampling rate' )
+        starttime = UTCDateTime( starttime ) if starttime is not None else min( tr.stats.starttime for tr in st )
+        endtime = UTCDateTime( endtime ) if endtime is not None else max( tr.stats.endtime for tr in st )
+        npts = max( 0, int( round( ( endtime - starttime ) / delta ) ) + 1 )
+
+        rows = {}
+        stats = []
+        positions = []
+        for position, tr in enumerate( st ):
+            if tr.id not in rows:
+                rows[tr.id] = len( stats )
+                stats.append( tr.stats.copy() )
+                positions.append( position )
+        data = np.zeros( ( len( stats ), npts ), dtype=dtype )
+        mask = np.ones( ( len( stats ), npts ), dtype=bool )
+
+        for tr in st:
+            row = rows[tr.id]
+            first = int( round( ( tr.stats.starttime - starttime ) / delta ) )
+            beg = max( 0, first )
+            end = min( npts, first + tr.stats.npts )
+            if end <= beg:
+                continue
+            piece = tr.data[ beg - first:end - first ]
+            data[ row, beg:end ] = np.ma.getdata( piece )
+            mask[ row, beg:end ] = np.ma.getmaskarray( piece )
+
+        return cls( data, starttime, delta, stats, mask if mask.any() else None, positions )
+
+    @property
+    def npts( self ):
+
+        return self.data.shape[1]
+
+    @property
+    def endtime( self ):
+
+        return self.starttime + ( self.npts - 1 ) * self.delta
+
+    def ids( self ):
+
+        return [ stats.network + '.' + stats.station + '.' + stats.location + '.' + stats.channel for stats in self.stats ]
+
+    def times( self ):
+        # Seconds from the start of the block of each sample
+
+        return np.arange( self.npts ) * self.delta
+
+    def absMax( self ):
+        # Largest absolute value of each row, 0 for a row with no data
+
+        values = np.abs( self.data )
+        if self.mask is not None:
+            values = np.where( self.mask, 0, values )
+        if self.npts == 0:
+            return np.zeros( len( self.stats ) )
+        return values.max( axis=1 )
+
+    def traces( self, split=False ):
+        # Traces of each row in turn, as (position, trace).  With split, gaps
+        # split rows into separate traces, otherwise rows with gaps are masked.
+
+        out = []
+        for row, ( stats, position ) in enumerate( zip( self.stats, self.positions ) ):
+            data = self.data[row]
+            mask = self.mask[row] if self.mask is not None else None
+            # Traces share the arrays of the block
+            if mask is None or not mask.any():
+                pieces = [ ( 0, data ) ]
+            elif split:
+                change = np.diff( np.concatenate([ [0], ( ~mask ).astype( np.int8 ), [0] ]) )
+                pieces = [ ( beg, data[ beg:end ] )
+                           for beg, end in zip( np.flatnonzero( change == 1 ), np.flatnonzero( change == -1 ) ) ]
+            elif mask.all():
+                pieces = []
+            else:
+                pieces = [ ( 0, np.ma.masked_array( data, mask=mask ) ) ]
+            for first, piece in pieces:
+                # The whole header is kept, so format details such as miniseed record lengths go with the trace
+                header = stats.copy()
+                header.delta = self.delta
+                header.starttime = self.starttime + first * self.delta
+                # obspy keeps npts from a header it is given, rather than taking it from the data
+                header.npts = len( piece )
+                tr = Trace( data=piece, header=header )
+                out.append( ( position, tr ) )
+        return out
+
+    def toStream( self, split=False ):
+
+        return Stream([ tr for position, tr in self.traces( split ) ])
+
+
+
+############  blocksFromStream: Function to return a block for each sampling rate in a stream
+def blocksFromStream( st, starttime=None, endtime=None, dtype=np.float64 ):
+
+    groups = {}
+    for position, tr in enumerate( st ):
+        rate = round( tr.stats.sampling_rate, 6 )
+        groups.setdefault( rate, ( Stream(), [] ) )
+        groups[rate][0].append( tr )
+        groups[rate][1].append( position )
+
+    blocks = []
+    for stRate, positions in groups.values():
+        block = ChannelBlock.fromStream( stRate, starttime, endtime, dtype )
+        # Positions in the whole stream
+        block.positions = [ positions[ position ] for position in block.positions ]
+        blocks.append( block )
+
+    return blocks
+
+
+
+############  streamFromBlocks: Function to return the traces of blocks as a stream, in the order they were made from
+def streamFromBlocks( blocks, split=False ):
+
+    traces = []
+    for block in blocks:
+        traces.extend( block.traces( split ) )
+    traces.sort( key=lambda item: item[0] )
+
+    return Stream([ tr for position, tr in traces ])
+
+
+
+############  normalizeStations: Function to scale the channels of each station by their largest absolute value
+def normalizeStations( blocks ):
+    # As Stream.normalize( global_max=True ) for each station, for all stations at once
+
+    stations = sorted( set( stats.station.upper() for block in blocks for stats in block.stats ) )
+    stationIndex = dict( ( sta, ista ) for ista, sta in enumerate( stations ) )
+    rowStations = [ np.array( [ stationIndex[ stats.station.upper() ] for stats in block.stats ], dtype=int ) for block in blocks ]
+
+    largest = np.zeros( len( stations ) )
+    for block, rowStation in zip( blocks, rowStations ):
+        np.maximum.at( largest, rowStation, block.absMax() )
+
+    for block, rowStation in zip( blocks, rowStations ):
+        scale = largest[ rowStation ]
+        # Stations with no signal are left alone, as obspy does
+        scale[ scale == 0 ] = 1.0
+        block.data /= scale[:, None]
+
+    return blocks
+
+
+
+############  mergeStream: Function to merge the pieces of each channel into one trace, with gaps masked
+def mergeStream( st ):
+    # Channels come in the order of their first piece.  Where pieces overlap the later one is kept.
+
+    groups = {}
+    for tr in st:
+        groups.setdefault( ( tr.id, round( tr.stats.sampling_rate, 6 ) ), [] ).append( tr )
+
+    out = Stream()
+    for trs in groups.values():
+        if len( trs ) == 1:
+            out += trs[0]
+            continue
+        dtype = np.result_type( *[ tr.data.dtype for tr in trs ] )
+        out += ChannelBlock.fromStream( Stream( trs ), dtype=dtype ).toStream()
+
+    return out
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# getnPlotCache.py
+#
+# Local on-disk cache of raw waveform blocks, shared by all getnPlot runs,
+# and of the winston wave server menu
+#
+# Data are cached as miniseed files, one per channel and per time block, with
+# blocks aligned to multiples of the block length.  Only blocks that are old enough
+# not to be still filling on the wave server are cached.  A block that came back empty or
+# with gaps, as during an outage or from a dead channel, is cached as incomplete and used
+# for an hour only, so it is not asked for on every run but is fetched again later in case
+# the data have turned up.  Least recently used
+# blocks are removed when the cache grows beyond its size limit, which is checked
+# against a running total of the sizes of blocks written rather than by walking the cache.
+#
+
+
+
+############  Imports
+import os
+import fcntl
+import json
+import math
+import tempfile
+import threading
+import time
+import warnings
+from collections import OrderedDict
+import obspy
+from obspy.core import UTCDateTime, Stream
+
+
+
+############  Warnings
+# Blocks are written from several threads at once, where catch_warnings is not safe, so obspy's
+# complaints about miniseed encodings are filtered once for the process instead
+warnings.filterwarnings( 'ignore', module='obspy.io.mseed' )
+
+
+
+############  BlockCache: Class for the on-disk cache of waveform blocks
+class BlockCache:
+
+    def __init__( self, cacheDir, maxMbytes=2000, blockSeconds=300, settleSeconds=600, memoryMbytes=500, incompleteSeconds=3600 ):
+
+        self.cacheDir = os.path.expanduser( cacheDir )
+        self.blockDir = os.path.join( self.cacheDir, 'blocks' )
+        self.maxBytes = int( maxMbytes * 1024 * 1024 )
+        self.blockSeconds = blockSeconds
+        self.settleSeconds = settleSeconds
+        self.incompleteSeconds = incompleteSeconds
+        os.makedirs( self.blockDir, exist_ok=True )
+
+        # Blocks are also kept in memory, which only helps a long-lived process such as the server
+        self.memory = OrderedDict()
+        self.memoryBytes = 0
+        self.memoryMaxBytes = int( memoryMbytes * 1024 * 1024 )
+        # Sources can be fetched in parallel threads
+        self.memoryLock = threading.Lock()
+
+        # Bytes written by this process not yet added to the total kept in blocks.size
+        self.addedBytes = 0
+        self.sizeLock = threading.Lock()
+
+    def blockRange( self, starttime, endtime ):
+
+        # Blocks hold samples from their start up to but not including their end, so a window
+        # ending on a block boundary also needs the block starting there for its last sample
+        first = int( math.floor( UTCDateTime( starttime ).timestamp / self.blockSeconds ) )
+        last = int( math.floor( UTCDateTime( endtime ).timestamp / self.blockSeconds ) )
+        return range( first, max( first, last ) + 1 )
+
+    def blockTimes( self, iblock ):
+
+        return ( UTCDateTime( iblock * self.blockSeconds ), UTCDateTime( (iblock+1) * self.blockSeconds ) )
+
+    def settled( self, iblock ):
+
+        return (iblock+1) * self.blockSeconds < time.time() - self.settleSeconds
+
+    def _path( self, source, nslc, iblock, complete=True ):
+
+        return os.path.join( self.blockDir, source, nslc, str( iblock ) + ( '.mseed' if complete else '.partial.mseed' ) )
+
+    def complete( self, st ):
+        # Whether traces fill a block, allowing a sample short for rounding of sample times
+
+        if len( st ) == 0:
+            return False
+        expected = self.blockSeconds * st[0].stats.sampling_rate
+        return sum( tr.stats.npts for tr in st ) >= expected - 1
+
+    def _remember( self, key, st ):
+
+        nbytes = sum( tr.data.nbytes for tr in st )
+        with self.memoryLock:
+            if key in self.memory:
+                self.memoryBytes -= self.memory.pop( key )[1]
+            self.memory[key] = ( st, nbytes )
+            self.memoryBytes += nbytes
+            while self.memoryBytes > self.memoryMaxBytes and self.memory:
+                self.memoryBytes -= self.memory.popitem( last=False )[1][1]
+
+    def get( self, source, nslc, iblock ):
+
+        key = ( source, nslc, iblock )
+        with self.memoryLock:
+            if key in self.memory:
+                self.memory.move_to_end( key )
+                stMemory = self.memory[key][0]
+            else:
+                stMemory = None
+        if stMemory is not None:
+            # Callers trim and merge traces in place
+            return stMemory.copy()
+
+        path = self._path( source, nslc, iblock )
+        try:
+            st = obspy.read( path, format='MSEED' )
+            # Touch so that eviction is least recently used
+            os.utime( path )
+        except ( FileNotFoundError, OSError, ValueError, TypeError ):
+            return self._getIncomplete( source, nslc, iblock )
+        self._remember( key, st.copy() )
+        return st
+
+    def _getIncomplete( self, source, nslc, iblock ):
+        # Incomplete blocks are not kept in memory, or touched, so they expire from when they were fetched
+
+        path = self._path( source, nslc, iblock, complete=False )
+        try:
+            if time.time() - os.stat( path ).st_mtime > self.incompleteSeconds:
+                return None
+            if os.path.getsize( path ) == 0:
+                # Nothing came back for this block
+                return Stream()
+            return obspy.read( path, format='MSEED' )
+        except ( FileNotFoundError, OSError, ValueError, TypeError ):
+            return None
+
+    def put( self, source, nslc, iblock, st ):
+
+        st = Stream( [ tr for tr in st if tr.stats.npts > 0 ] )
+        if not self.settled( iblock ):
+            return
+        complete = self.complete( st )
+        if complete:
+            self._remember( ( source, nslc, iblock ), st.copy() )
+        path = self._path( source, nslc, iblock, complete )
+        os.makedirs( os.path.dirname( path ), exist_ok=True )
+        # Write to a temporary file and rename, so other processes never see part of a block
+        fd, pathTmp = tempfile.mkstemp( dir=os.path.dirname( path ), suffix='.tmp' )
+        os.close( fd )
+        try:
+            # An empty file marks a block with no data
+            if len( st ) > 0:
+                st.write( pathTmp, format='MSEED' )
+            os.replace( pathTmp, path )
+            addedBytes = os.path.getsize( path )
+            if complete:
+                # Any incomplete copy from an earlier fetch is no longer wanted
+                pathIncomplete = self._path( source, nslc, iblock, complete=False )
+                try:
+                    sizeIncomplete = os.path.getsize( pathIncomplete )
+                    os.remove( pathIncomplete )
+                    addedBytes -= sizeIncomplete
+                except FileNotFoundError:
+                    pass
+            with self.sizeLock:
+                self.addedBytes += addedBytes
+        except Exception:
+            if os.path.exists( pathTmp ):
+                os.remove( pathTmp )
+
+    def evict( self ):
+
+        with self.sizeLock:
+            addedBytes = self.addedBytes
+        if addedBytes <= 0:
+            return
+
+        # Only one process at a time cleans up, or updates the total; bytes are added next time if busy
+        with open( os.path.join( self.cacheDir, 'blocks.lock' ), 'w' ) as fileLock:
+            try:
+                fcntl.flock( fileLock, fcntl.LOCK_EX | fcntl.LOCK_NB )
+            except BlockingIOError:
+                return
+            with self.sizeLock:
+                self.addedBytes -= addedBytes
+            pathSize = os.path.join( self.cacheDir, 'blocks.size' )
+            try:
+                with open( pathSize ) as fileSize:
+                    totalBytes = int( fileSize.read() ) + addedBytes
+            except ( OSError, ValueError ):
+                totalBytes = None
+            if totalBytes is not None and totalBytes <= self.maxBytes:
+                with open( pathSize, 'w' ) as fileSize:
+                    fileSize.write( str( totalBytes ) )
+                return
+
+            # Over the limit, or no total yet, so the cache is walked for the true sizes
+            files = []
+            totalBytes = 0
+            for root, dirs, names in os.walk( self.blockDir ):
+                for name in names:
+                    path = os.path.join( root, name )
+                    try:
+                        info = os.stat( path )
+                    except FileNotFoundError:
+                        continue
+                    files.append( (info.st_mtime, info.st_size, path) )
+                    totalBytes += info.st_size
+            if totalBytes > self.maxBytes:
+                # Remove oldest first, down to 90% of the limit
+                files.sort()
+                for mtime, size, path in files:
+                    if totalBytes <= 0.9 * self.maxBytes:
+                        break
+                    try:
+                        os.remove( path )
+                    except FileNotFoundError:
+                        pass
+                    totalBytes -= size
+            with open( pathSize, 'w' ) as fileSize:
+                fileSize.write( str( totalBytes ) )
+
+
+
+############  MenuCache: Class for the on-disk cache of wave server menus, reused until they are older than ttl seconds
+class MenuCache:
+
+    def __init__( self, cacheDir, ttl=300 ):
+
+        self.cacheDir = os.path.expanduser( cacheDir )
+        self.ttl = ttl
+        os.makedirs( self.cacheDir, exist_ok=True )
+
+    def _path( self, host, port ):
+
+        return os.path.join( self.cacheDir, 'menu-' + str( host ) + '-' + str( port ) + '.json' )
+
+    def get( self, host, port ):
+        # Returns menu and its age in seconds, or None if there is no fresh menu
+
+        try:
+            with open( self._path( host, port ) ) as fileMenu:
+                cached = json.load( fileMenu )
+        except ( FileNotFoundError, OSError, ValueError ):
+            return None
+        age = time.time() - cached['time']
+        if age > self.ttl or age < 0:
+            return None
+        menu = [ (net, sta, loc, cha, UTCDateTime( start ), UTCDateTime( end ))
+                 for net, sta, loc, cha, start, end in cached['menu'] ]
+        return menu, age
+
+    def put( self, host, port, menu ):
+
+        cached = { 'time': time.time(),
+                   'menu': [ (net, sta, loc, cha, start.timestamp, end.timestamp)
+                             for net, sta, loc, cha, start, end in menu ] }
+        path = self._path( host, port )
+        fd, pathTmp = tempfile.mkstemp( dir=self.cacheDir, suffix='.tmp' )
+        with os.fdopen( fd, 'w' ) as fileMenu:
+            json.dump( cached, fileMenu )
+        os.replace( pathTmp, path )
+
+
+
+############  sharedBlockCache, sharedMenuCache: Functions to return caches kept for the life of the process
+caches = {}
+
+def sharedBlockCache( cacheDir, maxMbytes=2000 ):
+
+    key = ( 'blocks', os.path.expanduser( cacheDir ) )
+    if key not in caches:
+        caches[key] = BlockCache( cacheDir, maxMbytes )
+    cache = caches[key]
+    cache.maxBytes = int( maxMbytes * 1024 * 1024 )
+    return cache
+
+
+def sharedMenuCache( cacheDir, ttl=300 ):
+
+    key = ( 'menu', os.path.expanduser( cacheDir ) )
+    if key not in caches:
+        caches[key] = MenuCache( cacheDir, ttl )
+    cache = caches[key]
+    cache.ttl = ttl
+    return cache
+
+
+
+############  fetchCached: Function to fetch channels through the block cache, asking the source only for missing blocks
+def fetchCached( cache, source, nslcs, starttime, endtime, fetcher ):
+    # nslcs are (net, sta, loc, cha) tuples.
+    # fetcher is called with a list of (net, sta, loc, cha, starttime, endtime) requests and returns a Stream.
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+
+    # Cached and fetched data are kept per channel, so the stream comes back in the order asked for
+    stNslcs = {}
+    requests = []
+    for net, sta, loc, cha in nslcs:
+        if loc == '--':
+            loc = ''
+        nslc = '.'.join([ net, sta, loc, cha ])
+        stNslcs[nslc] = Stream()
+        runFirst = None
+        for iblock in cache.blockRange( starttime, endtime ):
+            stBlock = cache.get( source, nslc, iblock )
+            if stBlock is None:
+                if runFirst is None:
+                    runFirst = iblock
+                runLast = iblock
+            else:
+                stNslcs[nslc] += stBlock
+                if runFirst is not None:
+                    requests.append( (net, sta, loc, cha, runFirst, runLast) )
+                    runFirst = None
+        if runFirst is not None:
+            requests.append( (net, sta, loc, cha, runFirst, runLast) )
+
+    if requests:
+        fetchRequests = []
+        for net, sta, loc, cha, runFirst, runLast in requests:
+            fetchRequests.append( (net, sta, loc, cha,
+                                   cache.blockTimes( runFirst )[0], cache.blockTimes( runLast )[1]) )
+        stNew = fetcher( fetchRequests )
+
+        # Store the new blocks
+        nslcsFetched = set()
+        for net, sta, loc, cha, runFirst, runLast in requests:
+            nslc = '.'.join([ net, sta, loc, cha ])
+            stFetched = stNew.select( network=net, station=sta, location=loc, channel=cha )
+            for iblock in range( runFirst, runLast+1 ):
+                if not cache.settled( iblock ):
+                    continue
+                blockBeg, blockEnd = cache.blockTimes( iblock )
+                stBlock = Stream()
+                for tr in stFetched:
+                    trBlock = tr.slice( blockBeg, blockEnd - 0.5*tr.stats.delta, nearest_sample=False )
+                    if trBlock.stats.npts > 0:
+                        stBlock += trBlock
+                cache.put( source, nslc, iblock, stBlock )
+            if nslc not in nslcsFetched:
+                stNslcs[nslc] += stFetched
+                nslcsFetched.add( nslc )
+        cache.evict()
+
+    st = Stream()
+    for nslc, stNslc in stNslcs.items():
+        # Blocks share samples at their ends with fetched data
+        stNslc.merge( method=-1 )
+        for tr in stNslc:
+            tr.trim( starttime, endtime )
+            if tr.stats.npts > 0:
+                st += tr
+
+    return st
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# getnPlotChannels.py
+#
+# Channels known to getnPlot, and which of them a plot needs.
+# Imported by getnPlot.py so the channel list can be worked out before any data is fetched.
+#
+# Once data are fetched, ChannelIndex sorts the traces by channel and by station in
+# one pass, so picking the channels for a plot is a lookup in a table rather than a
+# search through every trace for every station.
+#
+
+
+
+############  Channels wanted for all plot types
+nslcWant = {
+    'MV.MBBY.00.HH1', 'MV.MBBY.00.HH2', 'MV.MBBY.00.HHZ',
+    'MV.MBBY..BHE', 'MV.MBBY..BHN', 'MV.MBBY..BHZ',
+    'MV.MBFL.00.HH1', 'MV.MBFL.00.HH2', 'MV.MBFL.00.HHZ',
+    'MV.MBFL..BHE', 'MV.MBFL..BHN', 'MV.MBFL..BHZ',
+    'MV.MBFL..SHZ',
+    'MV.MBFL.00.HDF',
+    'MV.MBFR.00.HH1', 'MV.MBFR.00.HH2', 'MV.MBFR.00.HHZ',
+    'MV.MBFR..BHE', 'MV.MBFR..BHN', 'MV.MBFR..BHZ',
+    'MV.MBGA..SHZ',
+    'MV.MBGB.00.HH1', 'MV.MBGB.00.HH2', 'MV.MBGB.00.HHZ',
+    'MV.MBGB..BHE', 'MV.MBGB..BHN', 'MV.MBGB..BHZ',
+    'MV.MBGB..SHZ',
+    'MV.MBGH.00.HH1', 'MV.MBGH.00.HH2', 'MV.MBGH.00.HHZ',
+    'MV.MBGH..BHE', 'MV.MBGH..BHN', 'MV.MBGH..BHZ',
+    'MV.MBGH..SHZ',
+    'MV.MBHA.10.HHE', 'MV.MBHA.10.HHN', 'MV.MBHA.10.HHZ',
+    'MV.MBHA..BHE', 'MV.MBHA..BHN', 'MV.MBHA..BHZ',
+    'MV.MBHA..SHZ',
+    'MV.MBLG.00.HH1', 'MV.MBLG.00.HH2', 'MV.MBLG.00.HHZ',
+    'MV.MBLG..BHE', 'MV.MBLG..BHN', 'MV.MBLG..BHZ',
+    'MV.MBLG..SHZ',
+    'MV.MBLY.00.HH1', 'MV.MBLY.00.HH2', 'MV.MBLY.00.HHZ',
+    'MV.MBLY..BHE', 'MV.MBLY..BHN', 'MV.MBLY..BHZ',
+    'MV.MBRV..BHE', 'MV.MBRV..BHN', 'MV.MBRV..BHZ',
+#    'MV.MBRV..SHZ',
+    'MV.MBRY..BHE', 'MV.MBRY..BHN', 'MV.MBRY..BHZ',
+    'MV.MBWH.00.HH1', 'MV.MBWH.00.HH2', 'MV.MBWH.00.HHZ',
+    'MV.MBWH..BHE', 'MV.MBWH..BHN', 'MV.MBWH..BHZ',
+#    'MV.MBWH..SHZ',
+    'MV.MRYT..SHZ',
+    'MV.MSS1..SHZ',
+    'MC.AIRS..BLZ', 'MC.OLV1..BLZ', 'MC.TRNT..BLZ',
+    'CU.GRGR.00.BHZ', 'CU.GRGR.00.BH1', 'CU.GRGR.00.BH2',
+    'CU.ANWB.00.BHZ', 'CU.ANWB.00.BH1', 'CU.ANWB.00.BH2',
+    'CU.BBGH.00.BHZ', 'CU.BBGH.00.BH1', 'CU.BBGH.00.BH2',
+    'WI.ABD.00.HHZ', 'WI.ABD.00.HHN', 'WI.ABD.00.HHE',
+    'WI.DHS.00.HHZ', 'WI.DHS.00.HHN', 'WI.DHS.00.HHE',
+    'NA.SABA..BHZ', 'NA.SABA..BHN', 'NA.SABA..BHE',
+    'TR.SVT..HHZ', 'TR.SVT..HHN', 'TR.SVT..HHE',
+    'TR.DSLB..HHZ', 'TR.DSLB..HHN', 'TR.DSLB..HHE',
+    'MC.OLV1..BHZ', 'MC.OLV1..BHE', 'MC.OLV1..BHN',
+    'MC.TRNT..BHZ', 'MC.TRNT..BHE', 'MC.TRNT..BHN'
+}
+
+
+
+############  nslcForPlot: Function to return the wanted channels needed by the stations and channel type of a plot
+def nslcForPlot( stas, chas ):
+
+    stasWant = [ sta.upper() for sta in stas ]
+
+    nslcs = []
+    for nslc in sorted( nslcWant ):
+        net, sta, loc, cha = nslc.split('.')
+        if sta.upper() not in stasWant:
+            continue
+        if chas == 'z':
+            want = cha.endswith('Z')
+        elif chas == 'h':
+            want = cha == 'HDF'
+        elif chas == 'hz':
+            want = cha.endswith('Z') or cha == 'HDF'
+        else:
+            # 3c and all pick between HH, BH, SH and BL channels after fetching
+            want = True
+        if want:
+            nslcs.append( nslc )
+
+    return nslcs
+
+
+
+############  nslcKey: Function to turn waveserver menu or trace codes into a key for matching against wanted channels
+def nslcKey( net, sta, loc, cha ):
+
+    if loc == '--':
+        loc = ''
+
+    return '.'.join([ net, sta, loc, cha ]).upper()
+
+
+
+############  Channel preference
+# Bands tried in turn for each station in 3c and all plots, as (channel prefix, channels needed)
+bandsPrefer3c = [ ( 'HH', 3 ), ( 'BH', 3 ), ( 'SHZ', 1 ), ( 'BLZ', 1 ) ]
+bandsPreferAll = [ ( 'HH', 3 ), ( 'BH', 3 ), ( 'SHZ', 1 ) ]
+# Place of each component among the three of a station, by last letter of the channel
+componentSlots = { 'Z': 1, '1': 2, 'E': 2, '2': 3, 'N': 3 }
+
+
+
+############  ChannelIndex: Class holding the traces of a stream by channel and by station
+class ChannelIndex:
+
+    def __init__( self, st, keysWant=None ):
+        # keysWant are nslcKey of the channels to keep, all if None
+
+        self.traces = []
+        self.byKey = {}
+        self.byStation = {}
+        for tr in st:
+            key = nslcKey( tr.stats.network, tr.stats.station, tr.stats.location, tr.stats.channel )
+            if keysWant is not None and key not in keysWant:
+                continue
+            self.traces.append( tr )
+            self.byKey.setdefault( key, [] ).append( tr )
+            # Channels of each station in the order first seen
+            channels = self.byStation.setdefault( tr.stats.station.upper(), {} )
+            channels.setdefault( tr.stats.channel.upper(), [] ).append( tr )
+
+    def channel( self, nslc ):
+        # Traces of a channel, given as NET.STA.LOC.CHA
+
+        return self.byKey.get( nslcKey( *nslc.split('.') ), [] )
+
+    def first( self, sta, channel=None, component=None ):
+        # First trace of a station with the channel, or with the last letter of channel, or None
+
+        for cha, traces in self.byStation.get( sta.upper(), {} ).items():
+            if channel is not None and cha != channel.upper():
+                continue
+            if component is not None and not cha.endswith( component.upper() ):
+                continue
+            return traces[0]
+        return None
+
+    def preferred( self, sta, bands ):
+        # First trace of each channel of the first band the station has all channels of,
+        # as (place among three, trace), or [] if none
+
+        channels = self.byStation.get( sta.upper(), {} )
+        for prefix, needed in bands:
+            chas = [ cha for cha in channels if cha.startswith( prefix ) ]
+            if len( chas ) == needed:
+                return [ ( componentSlots.get( cha[-1], 1 ), channels[cha][0] ) for cha in chas ]
+        return []
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# getnPlotDraw.py
+#
+# Plotting of long windows for getnPlot.py: helicorders, waveforms and lines drawn by other modules
+#
+# Long windows have far more samples than there are pixels to show them, so each
+# trace is reduced to the minimum and maximum in every pixel column before drawing.
+# This looks the same as plotting every sample, but takes the same time whatever
+# the length of the window.
+#
+
+
+
+############  Imports
+from datetime import datetime
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from obspy.core import UTCDateTime, Stream
+
+
+
+############  Constants
+# Data range of one helicorder line for each station, divided by --heliscale
+heliScaleStations = { 'MSS1': 1500, 'MBHA': 500, 'MBLG': 10000, 'MBLY': 10000, 'MBRV': 2500, 'MBRY': 5000 }
+heliScaleDefault = 10000
+
+
+
+############  minMaxColumns: Function to return minimum and maximum of data between sample indices
+def minMaxColumns( data, edges ):
+    # edges are the first sample of each column, plus one after the last column.
+    # Columns with no samples, or only masked samples, give NaN.
+
+    edges = np.asarray( edges, dtype=np.int64 )
+    nColumns = len( edges ) - 1
+    mins = np.full( nColumns, np.nan )
+    maxs = np.full( nColumns, np.nan )
+
+    if np.ma.isMaskedArray( data ) and np.ma.getmask( data ) is not np.ma.nomask:
+        data = data.astype( float ).filled( np.nan )
+        minimum, maximum = np.fmin, np.fmax
+    else:
+        data = np.asarray( data )
+        minimum, maximum = np.minimum, np.maximum
+
+    # Only columns that hold samples, with column ends clipped to the data
+    begs = np.clip( edges[:-1], 0, len( data ) )
+    ends = np.clip( edges[1:], 0, len( data ) )
+    full = ends > begs
+    if not full.any():
+        return mins, maxs
+    # reduceat runs from each start to the next, so columns must be contiguous;
+    # only the last column can be cut short by the end of the data
+    first = np.argmax( full )
+    last = len( full ) - np.argmax( full[::-1] ) - 1
+    starts = begs[ first:last+1 ]
+    stop = ends[ last ]
+    mins[ first:last+1 ] = minimum.reduceat( data[:stop], starts )
+    maxs[ first:last+1 ] = maximum.reduceat( data[:stop], starts )
+    # reduceat gives one sample for a column that starts where the next does
+    empty = ~full[ first:last+1 ]
+    mins[ first:last+1 ][ empty ] = np.nan
+    maxs[ first:last+1 ][ empty ] = np.nan
+
+    return mins, maxs
+
+
+
+############  plotMethod: Function to return the obspy Stream.plot method, min/max per pixel when there are more samples than pixels
+def plotMethod( st, width, starttime, endtime, samplesPerPixel=4 ):
+
+    seconds = UTCDateTime( endtime ) - UTCDateTime( starttime )
+    npts = max( [ seconds * tr.stats.sampling_rate for tr in st ], default=0 )
+    if npts > samplesPerPixel * width:
+        return 'fast'
+
+    return 'full'
+
+
+
+############  splitMasked: Function to return a stream with traces that have gaps split at them, for obspy's 'fast' method
+def splitMasked( st ):
+    # obspy's min/max plotting takes the fill value of masked samples as data.  Traces without
+    # gaps are passed on as they are, not copied.
+
+    out = Stream()
+    for tr in st:
+        if np.ma.isMaskedArray( tr.data ) and np.ma.getmask( tr.data ) is not np.ma.nomask:
+            out += tr.split()
+        else:
+            out += tr
+
+    return out
+
+
+
+############  decimateLines: Function to reduce lines already drawn on a figure to the minimum and maximum in each pixel
+def decimateLines( fig, samplesPerPixel=4 ):
+    # For figures drawn elsewhere, such as by rodsPythonThings.  Only lines with x
+    # in order and no markers are reduced, so particle motion and the like are left alone.
+
+    for ax in fig.axes:
+        xLimits = ax.get_xlim()
+        xSpan = abs( xLimits[1] - xLimits[0] )
+        width = max( 1, int( ax.get_window_extent().width ) )
+        for line in ax.get_lines():
+            if line.get_marker() not in ( None, 'None', 'none', '', ' ' ):
+                continue
+            x = np.asarray( line.get_xdata(), dtype=float )
+            y = line.get_ydata()
+            if len( x ) <= samplesPerPixel * width or len( x ) != len( y ) or xSpan == 0:
+                continue
+            if not ( np.diff( x ) >= 0 ).all():
+                continue
+            nColumns = max( 1, int( np.ceil( width * ( x[-1] - x[0] ) / xSpan ) ) )
+            edges = np.searchsorted( x, np.linspace( x[0], x[-1], nColumns + 1 ), side='left' )
+            edges[-1] = len( x )
+            mins, maxs = minMaxColumns( y, edges )
+            # Minimum at the first sample of each column and maximum at the last, so the line keeps its extent
+            begs = np.minimum( edges[:-1], len( x ) - 1 )
+            ends = np.maximum( edges[1:] - 1, begs )
+            xNew = np.empty( 2 * nColumns )
+            yNew = np.empty( 2 * nColumns )
+            xNew[0::2] = x[begs]
+            xNew[1::2] = x[ends]
+            yNew[0::2] = mins
+            yNew[1::2] = maxs
+            line.set_data( xNew, yNew )
+
+
+
+############  heliScalingRange: Function to return the data range of one helicorder line, 0 to fit the data
+def heliScalingRange( sta, heliScale ):
+
+    if heliScale <= 0:
+        return 0.0
+
+    return heliScaleStations.get( sta, heliScaleDefault ) / heliScale
+
+
+
+############  heliFigure: Function to draw a helicorder, looking like obspy's dayplot
+def heliFigure( tr, starttime, endtime, interval, size, scalingRange=0.0, colors=('k', 'r', 'b', 'g'),
+                linewidth=0.5, tickFormat='%H:%M', dpi=100 ):
+    # interval is the length of each line in seconds.
+    # scalingRange is the data range that fills one line, 0 to fit the largest, None for 99.5% of the data.
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+
+    fig = plt.figure( figsize=( size[0]/dpi, size[1]/dpi ), dpi=dpi )
+    ax = fig.add_subplot( 1, 1, 1, facecolor='w' )
+    left, right, top, bottom = 0.12, 0.88, 0.95, 0.1
+    fig.subplots_adjust( left=left, right=right, top=top, bottom=bottom )
+
+    # One column for each pixel across the plot
+    nColumns = max( 2, int( round( size[0] * ( right - left ) ) ) )
+    nLines = max( 1, int( np.ceil( ( endtime - starttime ) / interval - 2e-2 ) ) )
+
+    # Lines follow on from each other, so column edges run on from line to line,
+    # counted in samples from the start of the trace
+    sr = tr.stats.sampling_rate
+    offset = ( tr.stats.starttime - starttime ) * sr
+    edges = np.round( np.arange( nLines * nColumns + 1 ) * ( interval * sr / nColumns ) - offset )
+    mins, maxs = minMaxColumns( tr.data, edges )
+    mins = mins.reshape( nLines, nColumns )
+    maxs = maxs.reshape( nLines, nColumns )
+    calib = tr.stats.calib
+    if calib != 1.0:
+        mins = mins * calib
+        maxs = maxs * calib
+
+    # Scaling as in dayplot
+    valid = ~np.isnan( mins )
+    if valid.any():
+        mean = ( mins[valid].sum() + maxs[valid].sum() ) / ( 2 * valid.sum() )
+    else:
+        mean = 0.0
+    if scalingRange is None:
+        maxVal = np.sort( maxs[valid] - mean )[ int( 0.995 * valid.sum() ) ] if valid.any() else 1.0
+        minVal = np.sort( mins[valid] - mean )[ int( 0.005 * valid.sum() ) ] if valid.any() else 1.0
+    elif float( scalingRange ) == 0.0:
+        maxVal = np.nanmax( maxs ) - mean if valid.any() else 1.0
+        minVal = np.nanmin( mins ) - mean if valid.any() else 1.0
+    else:
+        maxVal = minVal = abs( scalingRange ) / 2.0
+    norm = max( abs( maxVal ), abs( minVal ) ) * 2
+    if norm == 0:
+        norm = 1.0
+
+    # Each line is centred on its own mean, from top to bottom
+    with np.errstate( invalid='ignore' ):
+        lineMeans = np.nanmean( ( mins + maxs ) / 2.0, axis=1 ) if valid.any() else np.zeros( nLines )
+    lineMeans = np.nan_to_num( lineMeans )
+    rowCentres = nLines - np.arange( nLines ) - 0.5
+    lower = rowCentres[:, None] + ( mins - lineMeans[:, None] ) / norm
+    upper = rowCentres[:, None] + ( maxs - lineMeans[:, None] ) / norm
+
+    # Zig-zag between minimum and maximum of each column, broken at gaps, all in one collection
+    x = np.repeat( np.arange( nColumns, dtype=float ), 2 )
+    segments = []
+    segmentColors = []
+    for iline in range( nLines ):
+        y = np.empty( 2 * nColumns )
+        y[0::2] = lower[iline]
+        y[1::2] = upper[iline]
+        good = ~np.isnan( y )
+        if not good.any():
+            continue
+        # Runs of good points
+        change = np.diff( np.concatenate([ [0], good.astype( np.int8 ), [0] ]) )
+        for beg, end in zip( np.flatnonzero( change == 1 ), np.flatnonzero( change == -1 ) ):
+            segments.append( np.column_stack([ x[beg:end], y[beg:end] ]) )
+            segmentColors.append( colors[ iline % len( colors ) ] )
+    ax.add_collection( LineCollection( segments, colors=segmentColors, linewidths=linewidth ) )
+
+    ax.set_xlim( 0, nColumns - 1 )
+    ax.set_ylim( -0.3, nLines + 0.3 )
+    _heliTicks( ax, starttime, interval, nLines, nColumns, tickFormat )
+    ax.grid( color='black', linestyle=':', linewidth=0.5 )
+    ax.yaxis.grid( False )
+    fig.suptitle( tr.id, fontsize=10 )
+
+    return fig
+
+
+
+############  _heliTicks: Function to label helicorder axes as dayplot does
+def _heliTicks( ax, starttime, interval, nLines, nColumns, tickFormat ):
+
+    # Time along each line
+    if interval < 240:
+        timeType, timeValue = 'seconds', interval
+    elif interval < 24000:
+        timeType, timeValue = 'minutes', interval / 60
+    else:
+        timeType, timeValue = 'hours', interval / 3600
+    counts = { 900: 16, 1200: 5, 1800: 7, 3600: 5, 5400: 7, 7200: 5, 10800: 7, 14400: 7, 18000: 7, 21600: 13, 43200: 13 }
+    count = counts.get( int( interval ) if interval == int( interval ) else None )
+    if not count:
+        if timeValue <= 15 and timeValue % 1 == 0:
+            count = int( timeValue ) + 1
+        else:
+            count = 10
+            for divisor in range( 15, 1, -1 ):
+                if timeValue % divisor == 0:
+                    count = divisor + 1
+                    break
+        while count < 5:
+            count *= 2
+    labels = []
+    for value in np.linspace( 0.0, timeValue, count ):
+        labels.append( f'{value:.0f}' if int( value ) == value else str( value ) )
+    ax.set_xticks( np.linspace( 0.0, nColumns - 1, count ) )
+    ax.set_xticklabels( labels, size=8 )
+    ax.set_xlabel( 'time in ' + timeType, size=8 )
+
+    # Start time of lines
+    if interval < 60 and 60 % interval == 0:
+        repeat = int( 60 // interval )
+    elif interval < 1800 and 3600 % interval == 0:
+        repeat = int( 3600 // interval )
+    else:
+        repeat = min( 10, nLines )
+    if nLines <= 5:
+        repeat = 1
+    steps = list( range( 0, nLines, repeat ) )
+    ax.set_yticks( [ nLines - step - 0.5 for step in steps ] )
+    ax.set_yticklabels( [ ( starttime + step * interval ).strftime( tickFormat ) for step in steps ], size=8 )
+    timeOffset = round( ( UTCDateTime( datetime.now() ) - UTCDateTime() ) / 3600.0, 2 )
+    sign = ( '%+i' % timeOffset )[0]
+    ax.set_ylabel( 'UTC (local time = UTC %s %02i:%02i)' % ( sign, abs( timeOffset ), ( timeOffset % 1 * 60 ) ) )
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# getnPlotEvents.py
+#
+# Index of the seisan event files (WAV/MVOE_/yyyy/mm/), used by getnPlot.py for
+# --source FILENAME and --source event
+#
+# The index is an sqlite database in the cache directory holding the name, path and
+# start time of each file, with its duration and channels once its headers have been
+# read.  Directories are listed again only when they have changed, so keeping the
+# index up to date costs one stat per directory instead of a walk of the whole tree.
+# Start times come from the file names, so only files near a wanted time have their
+# headers read.
+#
+# Lookup from the command line:
+#   getnPlotEvents.py FILENAME
+#   getnPlotEvents.py yyyy-mm-ddThh:mm:ss
+#
+
+
+
+############  Imports
+import os
+import re
+import sys
+import json
+import sqlite3
+import warnings
+import obspy
+from obspy.core import UTCDateTime
+
+
+
+############  Constants
+pathWavDefault = '/mnt/mvofls2/Seismic_Data/WAV/MVOE_'
+cacheDirDefault = '~/.cache/getnPlot'
+# Longest event file, so files starting this long before a time are checked for it
+eventSecondsMax = 3600
+# yyyy-mm-dd-hhmm-ssS.NET___nnn
+reWavName = re.compile( r'^(\d{4})-(\d{2})-(\d{2})-(\d{2})(\d{2})-(\d{2})' )
+
+
+
+############  nameTime: Function to return the start time given by an event file name, or None
+def nameTime( name ):
+
+    match = reWavName.match( name )
+    if not match:
+        return None
+    year, month, day, hour, minute, second = [ int( x ) for x in match.groups() ]
+    try:
+        return UTCDateTime( year, month, day, hour, minute, second )
+    except ValueError:
+        return None
+
+
+
+############  EventIndex: Class for the index of event files
+class EventIndex:
+
+    def __init__( self, pathWav=pathWavDefault, cacheDir=cacheDirDefault ):
+
+        self.pathWav = pathWav
+        self.pathDb = os.path.join( os.path.expanduser( cacheDir ), 'event-index.sqlite' )
+        self.conn = None
+        self.pid = None
+
+    def _db( self ):
+
+        # sqlite connections can not be shared with forked processes
+        if self.conn is not None and self.pid == os.getpid():
+            return self.conn
+        try:
+            os.makedirs( os.path.dirname( self.pathDb ), exist_ok=True )
+            conn = sqlite3.connect( self.pathDb, timeout=30 )
+            conn.execute( 'PRAGMA journal_mode=WAL' )
+        except ( OSError, sqlite3.Error ):
+            # No cache directory, so only index for this run
+            conn = sqlite3.connect( ':memory:' )
+        conn.execute( 'CREATE TABLE IF NOT EXISTS events ( name TEXT, path TEXT PRIMARY KEY, root TEXT, starttime REAL,'
+                      ' duration REAL, channels TEXT )' )
+        conn.execute( 'CREATE TABLE IF NOT EXISTS dirs ( path TEXT PRIMARY KEY, mtime INTEGER )' )
+        conn.execute( 'CREATE INDEX IF NOT EXISTS eventsName ON events ( name )' )
+        conn.execute( 'CREATE INDEX IF NOT EXISTS eventsTime ON events ( root, starttime )' )
+        conn.commit()
+        self.conn = conn
+        self.pid = os.getpid()
+        return conn
+
+    def _refreshDir( self, path ):
+        # Add files new to a month directory, and drop those gone, if it has changed; returns whether it exists
+
+        try:
+            mtime = os.stat( path ).st_mtime_ns
+        except OSError:
+            return False
+        db = self._db()
+        row = db.execute( 'SELECT mtime FROM dirs WHERE path = ?', ( path, ) ).fetchone()
+        if row is not None and row[0] == mtime:
+            return True
+        try:
+            names = set( name for name in os.listdir( path ) if not name.startswith( '.' ) )
+        except OSError:
+            return False
+        known = set( name for name, in db.execute( 'SELECT name FROM events WHERE substr( path, 1, ? ) = ?',
+                                                   ( len( path ) + 1, path + '/' ) ) )
+        with db:
+            for name in known - names:
+                db.execute( 'DELETE FROM events WHERE path = ?', ( os.path.join( path, name ), ) )
+            for name in names - known:
+                datim = nameTime( name )
+                db.execute( 'INSERT OR REPLACE INTO events VALUES ( ?, ?, ?, ?, NULL, NULL )',
+                            ( name, os.path.join( path, name ), self.pathWav,
+                              datim.timestamp if datim is not None else None ) )
+            db.execute( 'INSERT OR REPLACE INTO dirs VALUES ( ?, ? )', ( path, mtime ) )
+        return True
+
+    def refresh( self ):
+        # Bring the index of the whole tree up to date, listing only directories that have changed
+
+        for year in sorted( os.listdir( self.pathWav ) ) if os.path.isdir( self.pathWav ) else []:
+            pathYear = os.path.join( self.pathWav, year )
+            if not os.path.isdir( pathYear ):
+                continue
+            for month in sorted( os.listdir( pathYear ) ):
+                self._refreshDir( os.path.join( pathYear, month ) )
+
+    def _monthDir( self, datim ):
+
+        return os.path.join( self.pathWav, '%04d' % datim.year, '%02d' % datim.month )
+
+    def lookup( self, name ):
+        # Path of an event file from its name, or None
+
+        db = self._db()
+        for path, in db.execute( 'SELECT path FROM events WHERE name = ? AND root = ?', ( name, self.pathWav ) ).fetchall():
+            if os.path.isfile( path ):
+                return path
+
+        # Files are in the directory for the month of their name
+        datim = nameTime( name )
+        if datim is not None:
+            path = os.path.join( self._monthDir( datim ), name )
+            if os.path.isfile( path ):
+                self._refreshDir( self._monthDir( datim ) )
+                return path
+
+        self.refresh()
+        row = db.execute( 'SELECT path FROM events WHERE name = ? AND root = ?', ( name, self.pathWav ) ).fetchone()
+        if row is not None:
+            return row[0]
+        return None
+
+    def _header( self, path ):
+        # Duration and channels of a file, read from its headers once
+
+        db = self._db()
+        row = db.execute( 'SELECT starttime, duration, channels FROM events WHERE path = ?', ( path, ) ).fetchone()
+        if row is not None and row[1] is not None:
+            return row[0], row[1], json.loads( row[2] )
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter( 'ignore' )
+                st = obspy.read( path, headonly=True )
+        except Exception:
+            return None
+        if len( st ) == 0:
+            return None
+        starttime = min( tr.stats.starttime for tr in st ).timestamp
+        duration = max( tr.stats.endtime for tr in st ).timestamp - starttime
+        channels = sorted( set( tr.id for tr in st ) )
+        with db:
+            db.execute( 'UPDATE events SET starttime = ?, duration = ?, channels = ? WHERE path = ?',
+                        ( starttime, duration, json.dumps( channels ), path ) )
+        return starttime, duration, channels
+
+    def covering( self, starttime, endtime=None ):
+        # Paths of files with data at starttime, or overlapping starttime to endtime, in time order
+
+        starttime = UTCDateTime( starttime )
+        endtime = UTCDateTime( endtime ) if endtime is not None else starttime
+        earliest = starttime - eventSecondsMax
+        month = UTCDateTime( earliest.year, earliest.month, 1 )
+        while month <= endtime:
+            self._refreshDir( self._monthDir( month ) )
+            month = UTCDateTime( month.year + month.month // 12, month.month % 12 + 1, 1 )
+
+        db = self._db()
+        rows = db.execute( 'SELECT path FROM events WHERE root = ? AND starttime >= ? AND starttime <= ? ORDER BY starttime',
+                           ( self.pathWav, earliest.timestamp, endtime.timestamp ) ).fetchall()
+        paths = []
+        for path, in rows:
+            header = self._header( path )
+            if header is None:
+                continue
+            fileStart, duration, channels = header
+            if fileStart <= endtime.timestamp and fileStart + duration >= starttime.timestamp:
+                paths.append( path )
+        return paths
+
+    def channels( self, path ):
+        # Channel ids in a file
+
+        header = self._header( path )
+        return header[2] if header is not None else []
+
+
+
+############  sharedEventIndex: Function to return an index kept for the life of the process
+indexes = {}
+
+def sharedEventIndex( pathWav=pathWavDefault, cacheDir=cacheDirDefault ):
+
+    key = ( pathWav, os.path.expanduser( cacheDir ) )
+    if key not in indexes:
+        indexes[key] = EventIndex( pathWav, cacheDir )
+    return indexes[key]
+
+
+
+############  Look up a file name or time when run from the command line
+if __name__ == '__main__':
+
+    if len( sys.argv ) != 2:
+        print( 'usage: getnPlotEvents.py FILENAME | yyyy-mm-ddThh:mm:ss' )
+        sys.exit( 2 )
+
+    index = sharedEventIndex()
+    if re.match( r'^\d{4}-\d{2}-\d{2}T', sys.argv[1] ):
+        for path in index.covering( sys.argv[1] ):
+            print( path, ' '.join( index.channels( path ) ) )
+    else:
+        path = index.lookup( sys.argv[1] )
+        if path is None:
+            sys.exit( 1 )
+        print( path )
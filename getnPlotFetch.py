@@ -0,0 +1,680 @@
+#!/usr/bin/env python
+# getnPlotFetch.py
+#
+# Fetching of waveform data for getnPlot.py, getWaves.py and panPlots.py
+#
+# Requests to the winston wave server go through a small pool of open connections
+# and run in parallel, one request per channel (or per piece of a channel).
+# The miniseed archive is read through its index in getnPlotSds.py, and the 20 minute
+# continuous files of DSNC_ (the cont source) are read, trimmed and merged in memory.
+# Either source can be read through the local block cache in getnPlotCache.py.
+# When a shared window is set (batch mode), channels are fetched once for the whole
+# window and each plot inside it is cut from memory.
+#
+# The auto source asks the wave server and the archive at the same time.  Each channel
+# is taken from whichever source returns it whole first, and only the gaps it leaves
+# (missing channels, or missing stretches of a channel) are cut from the other source.
+#
+# When plots work through a list of windows (chunks of a long window, a batch of
+# events), or through windows that each start where the last one ended (as
+# the server sees them), a Prefetcher loads the next windows in the background while
+# the current one is plotted, holding no more than a set amount of data.
+#
+
+
+
+############  Imports
+import os
+import socket
+import threading
+import queue
+import time
+from collections import deque
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from obspy.clients.earthworm import Client
+from obspy.clients.earthworm.waveserver import TraceBuf2
+import obspy
+from obspy.core import UTCDateTime, Stream
+
+import getnPlotBlock
+import getnPlotCache
+import getnPlotChannels
+import getnPlotSds
+
+
+
+############  Constants
+# Continuous files, in DSNC_/yyyy/mm/ under the root for their year
+contRoot = '/mnt/mvofls2/Seismic_Data/WAV'
+contRootOld = '/mnt/mvohvs3/MVOSeisD6/WAV'
+contYearNew = 2011
+contDir = 'DSNC_'
+contSlotMinutes = 20
+# Missing samples allowed at the ends of a channel that is counted as whole, for rounding of the window
+completeSlackSamples = 1
+# Seconds by which a window may miss the end of the last one and still follow on from it
+sequentialSlackSeconds = 0.01
+
+
+
+############  WaveserverPool: Class holding a bounded pool of connections to a winston wave server
+class WaveserverPool:
+
+    def __init__( self, host, port, timeout=20, connections=4, menuCache=None ):
+
+        self.host = host
+        self.port = int( port )
+        self.timeout = timeout
+        self.connections = max( 1, int( connections ) )
+        self.slots = threading.BoundedSemaphore( self.connections )
+        self.idle = queue.LifoQueue()
+        self.menuCache = menuCache
+        self.menuAge = 0.0
+
+    def _connect( self, deadline ):
+
+        sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        sock.settimeout( _remaining( deadline ) )
+        sock.connect( (self.host, self.port) )
+        return sock
+
+    def _close( self, sock ):
+
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def getAvailability( self, network='*', station='*', channel='*' ):
+
+        # The whole menu is fetched, or taken from the menu cache, and then matched here,
+        # as winston can not restrict menu requests anyway
+        cached = None
+        if self.menuCache is not None:
+            cached = self.menuCache.get( self.host, self.port )
+        if cached is None:
+            # Menu requests are rare, so use obspy for them
+            client = Client( self.host, self.port, self.timeout )
+            menu = client.get_availability( network='*', station='*', channel='*' )
+            self.menuAge = 0.0
+            if self.menuCache is not None and menu:
+                self.menuCache.put( self.host, self.port, menu )
+        else:
+            menu, self.menuAge = cached
+
+        pattern = '.'.join([ network, station, '*', channel ])
+        return [ x for x in menu if fnmatch( '.'.join( x[:4] ), pattern ) ]
+
+    def getWaveforms( self, net, sta, loc, cha, starttime, endtime ):
+
+        starttime = UTCDateTime( starttime )
+        endtime = UTCDateTime( endtime )
+        if loc == '':
+            loc = '--'
+        request = 'GETSCNLRAW: getnplot %s %s %s %s %f %f\n' % ( sta, cha, net, loc, starttime.timestamp, endtime.timestamp )
+        request = request.encode( 'ascii', 'strict' )
+
+        # Timeout applies to the whole request, not to each read from the socket
+        deadline = time.monotonic() + self.timeout
+
+        self.slots.acquire()
+        try:
+            # A reused connection may have been closed by the server, so try once more on a new one
+            try:
+                sock = self.idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                sock = self._connect( deadline )
+                reused = False
+            try:
+                tbl = _requestTraceBufs( sock, request, deadline )
+            except ( ConnectionError, OSError ) as exc:
+                self._close( sock )
+                if not reused or isinstance( exc, socket.timeout ):
+                    raise
+                sock = self._connect( deadline )
+                try:
+                    tbl = _requestTraceBufs( sock, request, deadline )
+                except ( ConnectionError, OSError ):
+                    self._close( sock )
+                    raise
+            self.idle.put( sock )
+        finally:
+            self.slots.release()
+
+        st = Stream()
+        for tb in tbl:
+            st.append( tb.get_obspy_trace() )
+        st.merge( method=-1 )
+        st.trim( starttime, endtime )
+        return st
+
+    def close( self ):
+
+        while True:
+            try:
+                sock = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close( sock )
+
+
+
+############  sharedPool: Function to return a pool kept for the life of the process, so a server reuses its connections
+pools = {}
+
+def sharedPool( host, port, timeout=20, connections=4, menuCache=None ):
+
+    key = ( host, int( port ), timeout, int( connections ) )
+    if key not in pools:
+        pools[key] = WaveserverPool( host, port, timeout, connections, menuCache )
+    pool = pools[key]
+    pool.menuCache = menuCache
+    return pool
+
+
+
+############  SharedWindow: Class holding data for a window that several plots fall inside
+class SharedWindow:
+
+    def __init__( self, starttime, endtime ):
+
+        self.starttime = UTCDateTime( starttime )
+        self.endtime = UTCDateTime( endtime )
+        self.streams = {}
+
+    def covers( self, starttime, endtime ):
+
+        return self.starttime <= starttime and endtime <= self.endtime
+
+    def fetch( self, source, nslcs, starttime, endtime, fetcher ):
+        # fetcher is called with the channels not yet held, and the whole window
+
+        nslcs = [ tuple( nslc ) for nslc in nslcs ]
+        missing = [ nslc for nslc in nslcs if (source, nslc) not in self.streams ]
+        if missing:
+            stNew = fetcher( missing, self.starttime, self.endtime )
+            for nslc in missing:
+                net, sta, loc, cha = nslc
+                if loc == '--':
+                    loc = ''
+                self.streams[ (source, nslc) ] = stNew.select( network=net, station=sta, location=loc, channel=cha )
+
+        st = Stream()
+        for nslc in nslcs:
+            for tr in self.streams[ (source, nslc) ]:
+                trCut = tr.slice( starttime, endtime )
+                if trCut.stats.npts > 0:
+                    st += trCut.copy()
+        return st
+
+
+
+sharedWindow = None
+
+
+
+############  Prefetcher: Class loading the data of the windows expected next in the background
+class Prefetcher:
+
+    def __init__( self, windows=None, ahead=2, maxMbytes=500 ):
+        # windows are (starttime, endtime) of a list worked through in time order.  Without
+        # them, a window starting where one seen before ended, and as long, is taken to be part
+        # of a sweep, and the windows following on from it are expected next.
+
+        self.windows = sorted( ( UTCDateTime( beg ), UTCDateTime( end ) ) for beg, end in windows ) if windows is not None else None
+        self.ahead = max( 0, int( ahead ) )
+        self.maxBytes = int( maxMbytes * 1024 * 1024 )
+        self.seen = deque( maxlen=8 )
+        # (source, nslcs, starttime, endtime) -> [future, bytes held or expected]
+        self.entries = {}
+        self.nbytes = 0
+        self.lock = threading.RLock()
+        # Windows ahead are fetched at the same time, so a sweep slower to fetch than to plot still gains
+        self.executor = ThreadPoolExecutor( max_workers=max( 1, self.ahead ) )
+
+    def fetch( self, source, nslcs, starttime, endtime, fetcher ):
+        # fetcher is called with the channels and window, as a fetch of them would be
+
+        starttime = UTCDateTime( starttime )
+        endtime = UTCDateTime( endtime )
+        nslcs = [ tuple( nslc ) for nslc in nslcs ]
+        key = ( source, tuple( nslcs ), starttime.timestamp, endtime.timestamp )
+
+        with self.lock:
+            entry = self.entries.pop( key, None )
+            if entry is not None:
+                self.nbytes -= entry[1]
+            # Windows already passed will not be wanted
+            for keyOld in [ keyOld for keyOld in self.entries if keyOld[2] < starttime.timestamp ]:
+                self.entries[keyOld][0].cancel()
+                self.nbytes -= self.entries.pop( keyOld )[1]
+
+        st = None
+        if entry is not None:
+            try:
+                st = entry[0].result()
+            except Exception:
+                st = None
+        if st is None:
+            st = fetcher( nslcs, starttime, endtime )
+
+        self._fetchNext( source, nslcs, starttime, endtime, fetcher, st )
+        self.seen.append( ( starttime, endtime ) )
+        return st
+
+    def _next( self, starttime, endtime ):
+        # Windows expected after this one
+
+        if self.windows is not None:
+            return [ ( beg, end ) for beg, end in self.windows if beg > starttime ][ :self.ahead ]
+
+        dur = endtime - starttime
+        for beg, end in self.seen:
+            if abs( end - starttime ) <= sequentialSlackSeconds and abs( ( end - beg ) - dur ) <= sequentialSlackSeconds:
+                return [ ( starttime + iahead * dur, endtime + iahead * dur ) for iahead in range( 1, self.ahead + 1 ) ]
+        return []
+
+    def _fetchNext( self, source, nslcs, starttime, endtime, fetcher, st ):
+        # Start fetches of the next windows, while the data held stays within the limit
+
+        # Data expected for a window, from that of this one
+        bytesPerSecond = sum( tr.data.nbytes for tr in st ) / max( endtime - starttime, 1e-3 )
+        for beg, end in self._next( starttime, endtime ):
+            key = ( source, tuple( nslcs ), beg.timestamp, end.timestamp )
+            with self.lock:
+                if key in self.entries:
+                    continue
+                expected = int( bytesPerSecond * ( end - beg ) )
+                if self.nbytes + expected > self.maxBytes:
+                    break
+                try:
+                    future = self.executor.submit( fetcher, nslcs, beg, end )
+                except RuntimeError:
+                    # Closed
+                    return
+                self.entries[key] = [ future, expected ]
+                self.nbytes += expected
+            future.add_done_callback( lambda future, key=key: self._fetched( key, future ) )
+
+    def _fetched( self, key, future ):
+        # Count the data a window actually holds
+
+        with self.lock:
+            entry = self.entries.get( key )
+            if entry is None or entry[0] is not future:
+                return
+            try:
+                nbytes = sum( tr.data.nbytes for tr in future.result() )
+            except Exception:
+                nbytes = 0
+            self.nbytes += nbytes - entry[1]
+            entry[1] = nbytes
+
+    def close( self ):
+
+        with self.lock:
+            for future, nbytes in self.entries.values():
+                future.cancel()
+            self.entries = {}
+            self.nbytes = 0
+        self.executor.shutdown( wait=False )
+
+
+
+prefetcher = None
+
+
+
+############  prefetching: Context manager to fetch a list of windows through a prefetcher, putting back any there was before
+@contextmanager
+def prefetching( windows, ahead=2, maxMbytes=500 ):
+
+    global prefetcher
+
+    prefetcherSaved = prefetcher
+    if ahead > 0:
+        prefetcher = Prefetcher( windows, ahead, maxMbytes )
+    try:
+        yield
+    finally:
+        if prefetcher is not prefetcherSaved:
+            prefetcher.close()
+        prefetcher = prefetcherSaved
+
+
+
+############  _fetchAhead: Function to fetch a window through the prefetcher, if there is one
+def _fetchAhead( source, nslcs, starttime, endtime, fetcher ):
+
+    if prefetcher is None:
+        return fetcher( nslcs, starttime, endtime )
+    return prefetcher.fetch( source, nslcs, starttime, endtime, fetcher )
+
+
+
+############  fetchWaveserver: Function to fetch channels in parallel and return them as one stream, in the order asked for
+def fetchWaveserver( pool, nslcs, starttime, endtime, pieces=1, cache=None ):
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+
+    source = ('wws', pool.host, pool.port)
+    fetchWindow = lambda nslcsWindow, beg, end: _fetchWaveserver( pool, nslcsWindow, beg, end, pieces, cache )
+    if sharedWindow is not None and sharedWindow.covers( starttime, endtime ):
+        return sharedWindow.fetch( source, nslcs, starttime, endtime,
+                                   lambda nslcsMissing, beg, end: _fetchAhead( source, nslcsMissing, beg, end, fetchWindow ) )
+
+    return _fetchAhead( source, nslcs, starttime, endtime, fetchWindow )
+
+
+
+############  _fetchWaveserver: Function to fetch channels from the wave server, through the cache if there is one
+def _fetchWaveserver( pool, nslcs, starttime, endtime, pieces=1, cache=None ):
+
+    if cache is not None:
+        return getnPlotCache.fetchCached( cache, 'wws', nslcs, starttime, endtime,
+                                          lambda requests: fetchWaveserverRequests( pool, requests ) )
+
+    # Long windows for few channels can be split into pieces and fetched in parallel too
+    requests = []
+    pieceDur = ( endtime - starttime ) / pieces
+    for net, sta, loc, cha in nslcs:
+        for ipiece in range( pieces ):
+            pieceBeg = starttime + ipiece * pieceDur
+            pieceEnd = starttime + (ipiece+1) * pieceDur
+            requests.append( (net, sta, loc, cha, pieceBeg, pieceEnd) )
+
+    st = fetchWaveserverRequests( pool, requests )
+    if pieces > 1:
+        # Pieces share their end samples
+        st.merge( method=-1 )
+
+    return st
+
+
+
+############  availableInWindow: Function to keep menu entries that have data in a time window
+def availableInWindow( info, starttime, endtime, menuAge=0.0 ):
+
+    # Data will have been added since a cached menu was fetched
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+    return [ x for x in info if x[4] <= endtime and x[5] + menuAge >= starttime ]
+
+
+
+############  fetchWaveserverRequests: Function to run (net, sta, loc, cha, starttime, endtime) requests in parallel
+def fetchWaveserverRequests( pool, requests ):
+
+    def fetchOne( request ):
+        try:
+            return pool.getWaveforms( *request )
+        except ( ConnectionError, OSError, ValueError ):
+            return Stream()
+
+    with ThreadPoolExecutor( max_workers=pool.connections ) as executor:
+        streams = list( executor.map( fetchOne, requests ) )
+
+    st = Stream()
+    for stPart in streams:
+        st += stPart
+
+    return st
+
+
+
+############  fetchSds: Function to read channels from the SDS miniseed archive, through its index
+def fetchSds( pathMseed, nslcs, starttime, endtime, cache=None, index=None ):
+    # Channel codes may have wildcards
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+
+    if index is None:
+        index = getnPlotSds.sharedSdsIndex( pathMseed )
+
+    def fetchRequests( requests ):
+        # All day files of all channels are read at once
+        return index.readMany( requests )
+
+    def fetchWindow( nslcsWindow, beg, end ):
+        if cache is not None:
+            return getnPlotCache.fetchCached( cache, 'mseed', nslcsWindow, beg, end, fetchRequests )
+        return fetchRequests( [ (net, sta, loc, cha, beg, end) for net, sta, loc, cha in nslcsWindow ] )
+
+    source = ('mseed', pathMseed)
+    if sharedWindow is not None and sharedWindow.covers( starttime, endtime ):
+        return sharedWindow.fetch( source, nslcs, starttime, endtime,
+                                   lambda nslcsMissing, beg, end: _fetchAhead( source, nslcsMissing, beg, end, fetchWindow ) )
+
+    return _fetchAhead( source, nslcs, starttime, endtime, fetchWindow )
+
+
+
+############  channelGaps: Function to return the spans of a window with no data, for each channel wanted
+def channelGaps( st, keys, starttime, endtime ):
+    # keys are the getnPlotChannels.nslcKey of each channel.  Spans are (start, end), end being
+    # the time of the last missing sample, and channels with no data miss the whole window.
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+    gaps = dict( ( key, [ ( starttime, endtime ) ] ) for key in keys )
+
+    for tr in getnPlotBlock.mergeStream( st ):
+        key = tr.id.upper()
+        if key not in gaps:
+            continue
+        delta = tr.stats.delta
+        npts = int( round( ( endtime - starttime ) / delta ) ) + 1
+        missing = np.ones( npts, dtype=bool )
+        first = int( round( ( tr.stats.starttime - starttime ) / delta ) )
+        beg = max( 0, first )
+        end = min( npts, first + tr.stats.npts )
+        if end > beg:
+            missing[ beg:end ] = np.ma.getmaskarray( tr.data )[ beg - first:end - first ]
+        change = np.diff( np.concatenate([ [0], missing.astype( np.int8 ), [0] ]) )
+        spans = []
+        for begGap, endGap in zip( np.flatnonzero( change == 1 ), np.flatnonzero( change == -1 ) ):
+            # A sample short at either end of the window is rounding, not a gap
+            if endGap - begGap <= completeSlackSamples and ( begGap == 0 or endGap == npts ):
+                continue
+            spans.append( ( starttime + begGap * delta, starttime + ( endGap - 1 ) * delta ) )
+        gaps[key] = spans
+
+    return gaps
+
+
+
+############  fetchRace: Function to fetch channels from the wave server and the archive at once, each gap filled from the other
+def fetchRace( pool, pathMseed, nslcs, starttime, endtime, cache=None, index=None ):
+    # Returns the stream, with the pieces of each channel merged and in the order asked for,
+    # and the sources each channel came from.  A source that is not needed is not waited for.
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+    keys = [ getnPlotChannels.nslcKey( *nslc ) for nslc in nslcs ]
+
+    def fetchWws():
+        # Only channels the menu has for this time
+        try:
+            info = pool.getAvailability( network='*', station='*', channel='*' )
+        except OSError:
+            info = []
+        info = availableInWindow( info, starttime, endtime, pool.menuAge )
+        keysWant = set( keys )
+        nslcsWws = [ (net, sta, loc, cha) for net, sta, loc, cha, start, end in info
+                     if getnPlotChannels.nslcKey( net, sta, loc, cha ) in keysWant ]
+        if not nslcsWws:
+            return Stream()
+        return fetchWaveserver( pool, nslcsWws, starttime, endtime, cache=cache )
+
+    def fetchMseed():
+        return fetchSds( pathMseed, nslcs, starttime, endtime, cache=cache, index=index )
+
+    # Threads are daemons, so a wave server that does not answer does not hold up the end of the run.
+    # Warnings from reading and caching miniseed are filtered in getnPlotSds and getnPlotCache.
+    results = queue.Queue()
+    def run( name, fetcher ):
+        try:
+            st = fetcher()
+        except Exception:
+            st = Stream()
+        results.put( ( name, st ) )
+    for name, fetcher in ( ( 'waveserver', fetchWws ), ( 'mseed', fetchMseed ) ):
+        threading.Thread( target=run, args=( name, fetcher ), daemon=True ).start()
+
+    nameFirst, stFirst = results.get()
+    gaps = channelGaps( stFirst, keys, starttime, endtime )
+    sources = dict( ( key, [ nameFirst ] ) for key in keys if not gaps[key] )
+
+    if any( gaps.values() ):
+        nameSecond, stSecond = results.get()
+        for key in keys:
+            if gaps[key] and len( gaps[key] ) == 1 and gaps[key][0] == ( starttime, endtime ):
+                sources[key] = []
+            elif gaps[key]:
+                sources[key] = [ nameFirst ]
+        for tr in getnPlotBlock.mergeStream( stSecond ):
+            key = tr.id.upper()
+            for beg, end in gaps.get( key, [] ):
+                piece = tr.slice( beg, end )
+                if piece.stats.npts > 0 and np.ma.count( piece.data ) > 0:
+                    stFirst += piece
+                    if nameSecond not in sources[key]:
+                        sources[key].append( nameSecond )
+
+    # Channels in the order asked for
+    order = dict( ( key, ikey ) for ikey, key in enumerate( keys ) )
+    st = getnPlotBlock.mergeStream( stFirst )
+    st.traces.sort( key=lambda tr: order.get( tr.id.upper(), len( order ) ) )
+
+    return st, dict( ( key, ' + '.join( sources.get( key, [] ) ) or 'none' ) for key in keys )
+
+
+
+############  contFiles: Function to return the continuous files covering a window, as findWavGet found them
+def contFiles( starttime, endtime, listings=None ):
+    # Files start on the hour and at 20 and 40 minutes past, and are named
+    # yyyy-mm-dd-hhmm* or yyyy_mm_dd_hhmm*.  listings holds directory listings between calls.
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+    if listings is None:
+        listings = {}
+
+    slot = UTCDateTime( starttime.year, starttime.month, starttime.day, starttime.hour,
+                        starttime.minute // contSlotMinutes * contSlotMinutes )
+    files = []
+    while True:
+        root = contRootOld if slot.year < contYearNew else contRoot
+        dirWav = os.path.join( root, contDir, '%04d' % slot.year, '%02d' % slot.month )
+        if dirWav not in listings:
+            try:
+                listings[dirWav] = sorted( os.listdir( dirWav ) )
+            except OSError:
+                listings[dirWav] = []
+        for joiner in ( '-', '_' ):
+            prefix = joiner.join([ '%04d' % slot.year, '%02d' % slot.month, '%02d' % slot.day, '%02d' % slot.hour ]) + \
+                     '%02d' % slot.minute
+            files += [ os.path.join( dirWav, name ) for name in listings[dirWav] if name.startswith( prefix ) ]
+        slot += 60 * contSlotMinutes
+        if slot >= endtime:
+            break
+
+    return files
+
+
+
+############  fetchCont: Function to read the continuous files covering a window, trimmed and merged, in parallel
+def fetchCont( starttime, endtime, threads=4 ):
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+
+    def readOne( path ):
+        try:
+            return obspy.read( path, starttime=starttime, endtime=endtime )
+        except Exception:
+            # Anything obspy can not read is left out, as seisei did
+            return Stream()
+
+    files = contFiles( starttime, endtime )
+    with ThreadPoolExecutor( max_workers=max( 1, min( threads, len( files ) ) ) ) as executor:
+        streams = list( executor.map( readOne, files ) )
+
+    st = Stream()
+    for stFile in streams:
+        st += stFile
+    try:
+        st.merge( method=-1 )
+    except Exception:
+        # Channels with the same codes but different sample rates are left as they are
+        pass
+    st.trim( starttime, endtime )
+
+    return Stream( [ tr for tr in st if tr.stats.npts > 0 ] ), files
+
+
+
+############  _remaining: Function to return seconds left before a deadline, for socket timeouts
+def _remaining( deadline ):
+
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise socket.timeout( 'waveserver request timed out' )
+    return left
+
+
+
+############  _requestTraceBufs: Function to send one GETSCNLRAW request on an open socket and return its tracebufs
+def _requestTraceBufs( sock, request, deadline ):
+
+    sock.settimeout( _remaining( deadline ) )
+    sock.sendall( request )
+
+    # Header line
+    line = bytearray()
+    while True:
+        sock.settimeout( _remaining( deadline ) )
+        char = sock.recv( 1 )
+        if not char:
+            raise ConnectionError( 'waveserver closed connection' )
+        if char == b'\n':
+            break
+        line += char
+    tokens = line.decode( 'ascii', 'replace' ).split()
+    if len( tokens ) < 7 or tokens[6] != 'F':
+        # No data for this channel and time
+        return []
+
+    # Tracebufs
+    nbytes = int( tokens[-1] )
+    dat = bytearray( nbytes )
+    view = memoryview( dat )
+    got = 0
+    while got < nbytes:
+        sock.settimeout( _remaining( deadline ) )
+        n = sock.recv_into( view[got:], nbytes - got )
+        if n == 0:
+            raise ConnectionError( 'waveserver closed connection' )
+        got += n
+    dat = bytes( dat )
+
+    tbl = []
+    p = 0
+    while p + 64 < nbytes:
+        tb = TraceBuf2()
+        tb.parse_header( dat[p:p+64] )
+        p += 64
+        n = tb.ndata * tb.input_type.itemsize
+        if p + n > nbytes:
+            break
+        tb.parse_data( dat[p:p+n] )
+        tbl.append( tb )
+        p += n
+
+    return tbl
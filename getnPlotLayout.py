@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# getnPlotLayout.py
+#
+# Composite plots made of several getnPlot plots (getnPlot.py --layout NAME),
+# replacing the ImageMagick crop, resize and montage steps of getnPlotSpecial3,
+# getnPlotTfrAll, getnPlotTiledTfr, getnPlotHeli and getnPlotSpecial3Montage.
+#
+# Each panel is drawn by getnPlot.py as usual, but its figure is turned into pixels
+# in memory instead of being saved.  Panels are cropped, resized and tiled as the
+# scripts did, and the composite is saved as one PNG.  Panels are drawn in parallel
+# by forked processes, and nothing is written anywhere but the final file, so any
+# number of layouts can run at once in the same directory.  A panel asking for several
+# kinds of plot draws them in turn, as getnPlotBatch.mapJobs does not fork a pool
+# inside a process of the layout's own pool.
+#
+# Montage of existing plots from the command line (getnPlotSpecial3Montage):
+#   getnPlotLayout.py fileOut.png fileIn1.png fileIn2.png ...
+#
+
+
+
+############  Imports
+import os
+import sys
+from datetime import timedelta
+import numpy as np
+from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import getnPlotBatch
+import getnPlotFetch
+import getnPlotRun
+
+
+
+############  Layouts
+# Panels are (getnPlot arguments, crop as (width, height, x, y) or None, resize as (width, height) or None),
+# with the arguments given to getnPlot coming after the panel arguments, as in the scripts.
+stasTfrAll = [ 'MSS1', 'MBFR', 'MBLY', 'MBLG', 'MBRY', 'MBBY', 'MBHA', 'MBGH', 'MBWH', 'MBFL', 'MBGB', 'MBRV' ]
+stasSpecial3 = [ 'MSS1', 'MBFR', 'MBLY', 'MBLG', 'MBRY', 'MBBY', 'MBRV' ]
+stasTiledTfr = [ 'MBLY', 'MSS1', 'MBLG', 'MBBY', 'MBFR', 'MBRY' ]
+freqHPSpecial3 = '0.5'
+
+layoutChoices = [ 'special3', 'tfrall', 'tiledtfr', 'heli' ]
+
+
+
+############  panelsForLayout: Function to return the panels of a layout
+def panelsForLayout( layout, evDatim=None, windowDur=0, heliWidth=15.0 ):
+
+    if layout == 'special3':
+        panels = [ ( [ '--pre', '5', '--dur', '30', '--shape', 'thin', '--hpfilt', freqHPSpecial3 ], None, None ) ]
+        for sta in stasSpecial3:
+            panels.append( ( [ '--pre', '5', '--dur', '30', '--kind', 'tfr', '--sta', sta, '--fmin', '1.0', '--fmax', '50.0',
+                               '--hpfilt', freqHPSpecial3 ], (1654, 1113, 86, 117), (574, 432) ) )
+
+    elif layout == 'tfrall':
+        panels = [ ( [ '--kind', 'tfr', '--sta', sta ], None, None ) for sta in stasTfrAll ]
+
+    elif layout == 'tiledtfr':
+        panels = [ ( [ '--kind', 'tfr', '--sta', sta, '--title', 'sta' ], (1633, 1268, 110, 10), None )
+                   for sta in stasTiledTfr ]
+
+    elif layout == 'heli':
+        # One line of the helicorder for each heliWidth minutes
+        panels = []
+        lineSeconds = 60 * heliWidth
+        nLines = max( 1, int( np.ceil( windowDur / lineSeconds - 1e-9 ) ) )
+        for iline in range( nLines ):
+            datimLine = evDatim + timedelta( seconds=iline*lineSeconds )
+            panels.append( ( [ '--tag', 'GNPFH', '--shape', 'xxxxlong', '--pre', '0m', '--kind', 'Z', '--chaff', 'noscnl',
+                               '--nogreen', '--source', 'mseed' ], (3724, 91, 79, 61), None, datimLine ) )
+        return panels
+
+    return [ panel + ( None, ) for panel in panels ]
+
+
+
+############  runLayout: Function to draw a composite plot, returning exit status
+def runLayout( layout, argv, filePlot, evDatim, starttime, endtime, windowDur, heliWidth=15.0, jobs=1, runQuiet=False ):
+    # argv are the arguments given to getnPlot, without --layout.
+    # filePlot is the name getnPlot would give its own plot for these arguments.
+
+    panels = panelsForLayout( layout, evDatim, windowDur, heliWidth )
+
+    argvs = []
+    for argvPanel, crop, resize, datimPanel in panels:
+        if datimPanel is None:
+            argvs.append( argvPanel + argv )
+        else:
+            # Time and duration of helicorder lines replace those given
+            argvRest = getnPlotBatch.argvWithout( argv, [ '-d', '--date', '-t', '--time', '--datim', '-p', '--pre', '-l', '--dur' ] )
+            argvRest = [ arg for arg in argvRest if arg not in ( '--today', '--yesterday', '--yday' ) ]
+            argvs.append( argvPanel + argvRest + [ '--dur', str( heliWidth ) + 'm',
+                          '--date', datimPanel.strftime( '%Y-%m-%d' ), '--time', datimPanel.strftime( '%H:%M:%S.%f' ) ] )
+
+    if layout == 'heli':
+        starttime = evDatim
+        endtime = evDatim + timedelta( seconds=len( panels ) * 60 * heliWidth )
+
+    jobs = max( 1, int( jobs ) )
+    if not runQuiet:
+        print( 'Layout:             ' + layout )
+        print( ' Panels:            ' + str( len( panels ) ) )
+        print( ' Jobs:              ' + str( min( jobs, len( panels ) ) ) )
+
+    getnPlotFetch.sharedWindow = getnPlotFetch.SharedWindow( starttime, endtime )
+    try:
+        if jobs > 1 and len( argvs ) > 1:
+            getnPlotBatch.prefetch( argvs )
+        tasks = [ ( argvPanel, crop, resize ) for argvPanel, ( argvLayout, crop, resize, datimPanel ) in zip( argvs, panels ) ]
+        results = list( getnPlotBatch.mapJobs( _drawPanel, tasks, jobs ) )
+    finally:
+        getnPlotFetch.sharedWindow = None
+
+    # As with the scripts, panels with no plot (no data) are left out
+    images = []
+    for argvPanel, status, image, filePanel, output in results:
+        if image is None:
+            if not runQuiet:
+                print( 'No plot from: getnPlot ' + ' '.join( argvPanel ) )
+                if output.strip():
+                    print( output.rstrip() )
+            continue
+        images.append( image )
+    if not images or ( layout == 'special3' and results[0][2] is None ):
+        if not runQuiet:
+            print( 'No composite plot' )
+        return 1
+
+    # Name of composite, as the scripts gave it
+    dirOut, fileBase = os.path.split( filePlot )
+    if layout == 'special3':
+        fileBase = os.path.basename( results[0][3] ).replace( 'allz', 'special3' )
+        dirOut = os.path.dirname( results[0][3] )
+    elif layout == 'tfrall':
+        fileBase = fileBase.replace( 'allz', 'allz-tfr' )
+    elif layout == 'tiledtfr':
+        fileBase = fileBase.replace( 'allz', 'tiledTfrs' )
+    elif layout == 'heli':
+        fileBase = evDatim.strftime( '%Y%m%d-%H%M' ) + '--getnPlotHeli-' + \
+                   '%d' % heliWidth + 'm-' + '%d' % ( len( panels ) * heliWidth ) + 'm.png'
+    fileOut = os.path.join( dirOut, fileBase )
+
+    if layout == 'special3':
+        parts = [ resizeImage( images[0], (574, 1435), keepAspect=True ) ]
+        if len( images ) > 1:
+            parts.append( montage( images[1:], 1, len( images ) - 1, (1, 1) ) )
+        image = montage( parts, 1, 2, (1, 1) )
+        image = resizeImage( image, ( round( 0.4 * image.shape[1] ), round( 0.4 * image.shape[0] ) ) )
+    elif layout == 'tfrall':
+        image = montage( images, 4, 3, (0, 0) )
+    elif layout == 'tiledtfr':
+        image = montage( images, 3, 2, (0, 0) )
+    else:
+        image = montage( images, 1, len( images ), (0, 0) )
+
+    savePng( image, fileOut )
+    getnPlotRun.addOutput( fileOut )
+    if not runQuiet:
+        print( ' Plot file: ' + fileOut )
+
+    return 0
+
+
+
+############  _drawPanel: Function to draw one panel, returning its pixels
+def _drawPanel( task ):
+
+    argv, crop, resize = task
+
+    figures = []
+    getnPlotRun.figureSink = lambda fig, filePanel: figures.append( ( figureImage( fig ), filePanel ) )
+    try:
+        status, files, output = getnPlotRun.runJob( argv + [ '--quiet' ] )
+    finally:
+        getnPlotRun.figureSink = None
+
+    if not figures:
+        return ( argv, status, None, '', output )
+    image, filePanel = figures[-1]
+    if crop:
+        image = cropImage( image, crop )
+    if resize:
+        image = resizeImage( image, resize )
+
+    return ( argv, status, image, filePanel, output )
+
+
+
+############  figureImage: Function to turn a matplotlib figure into an RGBA array, as savefig would draw it
+def figureImage( fig ):
+
+    # Figures made by obspy have no canvas to draw on until saved
+    canvas = FigureCanvasAgg( fig )
+    canvas.draw()
+
+    return np.array( canvas.buffer_rgba() )
+
+
+
+############  cropImage: Function to crop an image as magick -crop WxH+X+Y does
+def cropImage( image, crop ):
+
+    width, height, x, y = crop
+
+    return image[ y:y+height, x:x+width ]
+
+
+
+############  resizeImage: Function to resize an image, to the size given or to fit within it
+def resizeImage( image, size, keepAspect=False ):
+
+    width, height = size
+    if keepAspect:
+        scale = min( width / image.shape[1], height / image.shape[0] )
+        width = max( 1, round( scale * image.shape[1] ) )
+        height = max( 1, round( scale * image.shape[0] ) )
+    if ( width, height ) == ( image.shape[1], image.shape[0] ):
+        return image
+
+    return np.asarray( Image.fromarray( image ).resize( (width, height), Image.LANCZOS ) )
+
+
+
+############  montage: Function to tile images as magick montage -tile CxR -geometry +X+Y does
+def montage( images, columns, rows, border ):
+    # Every cell is the size of the largest image plus the border on each side,
+    # with images centred in their cells on a white background
+
+    cellWidth = max( image.shape[1] for image in images ) + 2 * border[0]
+    cellHeight = max( image.shape[0] for image in images ) + 2 * border[1]
+    rows = min( rows, int( np.ceil( len( images ) / columns ) ) )
+    out = np.full( ( rows * cellHeight, columns * cellWidth, 4 ), 255, dtype=np.uint8 )
+    for iimage, image in enumerate( images[:columns*rows] ):
+        row, column = divmod( iimage, columns )
+        y = row * cellHeight + ( cellHeight - image.shape[0] ) // 2
+        x = column * cellWidth + ( cellWidth - image.shape[1] ) // 2
+        if image.shape[2] == 3:
+            out[ y:y+image.shape[0], x:x+image.shape[1], :3 ] = image
+        else:
+            out[ y:y+image.shape[0], x:x+image.shape[1] ] = image
+
+    return out
+
+
+
+############  savePng: Function to write an image, through a temporary file so a part-written plot is never seen
+def savePng( image, fileOut ):
+
+    fileTmp = fileOut + '.tmp' + str( os.getpid() )
+    Image.fromarray( image ).save( fileTmp, format='PNG' )
+    os.replace( fileTmp, fileOut )
+
+
+
+############  montageFiles: Function to put existing plots side by side
+def montageFiles( filesIn, fileOut, border=(10, 1) ):
+
+    images = [ np.asarray( Image.open( fileIn ).convert( 'RGBA' ) ) for fileIn in filesIn ]
+    savePng( montage( images, len( images ), 1, border ), fileOut )
+
+
+
+############  Montage existing plots when run from the command line
+if __name__ == '__main__':
+
+    if len( sys.argv ) < 3:
+        print( 'usage: getnPlotLayout.py fileOut.png fileIn1.png [fileIn2.png ...]' )
+        sys.exit( 2 )
+
+    montageFiles( sys.argv[2:], sys.argv[1] )
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# getnPlotRun.py
+#
+# Runs getnPlot.py inside an existing python process, so that imports, wave server
+# connections and caches are kept between plots.
+# Used by the getnPlot server (getnPlotServe.py).
+#
+
+
+
+############  Imports
+import os
+import sys
+import io
+import runpy
+import traceback
+
+
+
+############  State seen by getnPlot.py while it is running as a job
+inJob = False
+outputFiles = []
+# Set to stop getnPlot.py once it has fetched its data
+fetchOnly = False
+# Set to a function taking (figure, file name) to have plots handed over instead of saved
+figureSink = None
+
+pathScript = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'getnPlot.py' )
+
+
+
+############  addOutput: Function called by getnPlot.py for each file it writes
+def addOutput( fileOut ):
+
+    outputFiles.append( os.path.abspath( fileOut ) )
+
+
+
+############  devNull: Function to return a file that discards all written to it, opened once for all jobs
+devNullFile = None
+
+def devNull():
+
+    global devNullFile
+
+    if devNullFile is None or devNullFile.closed:
+        devNullFile = open( os.devnull, 'w' )
+    return devNullFile
+
+
+
+############  runJob: Function to run getnPlot.py with a list of arguments, returning exit status, output files and screen output
+def runJob( argv, cwd=None ):
+
+    global inJob, outputFiles
+
+    import matplotlib.pyplot as plt
+
+    # Jobs can run jobs of their own (batch mode)
+    inJobSaved = inJob
+    outputFilesSaved = outputFiles
+    argvSaved = sys.argv
+    stdoutSaved = sys.stdout
+    stderrSaved = sys.stderr
+    cwdSaved = os.getcwd()
+
+    screen = io.StringIO()
+    sys.argv = [ 'getnPlot.py' ] + list( argv )
+    sys.stdout = screen
+    sys.stderr = screen
+    inJob = True
+    outputFiles = []
+    try:
+        if cwd:
+            os.chdir( cwd )
+        runpy.run_path( pathScript, run_name='__main__' )
+        status = 0
+    except SystemExit as exc:
+        if exc.code is None:
+            status = 0
+        elif isinstance( exc.code, int ):
+            status = exc.code
+        else:
+            print( exc.code )
+            status = 1
+    except Exception:
+        traceback.print_exc( file=screen )
+        status = 1
+    finally:
+        inJob = inJobSaved
+        filesJob = outputFiles
+        outputFiles = outputFilesSaved
+        sys.argv = argvSaved
+        sys.stdout = stdoutSaved
+        sys.stderr = stderrSaved
+        os.chdir( cwdSaved )
+        plt.close( 'all' )
+
+    return status, list( filesJob ), screen.getvalue()
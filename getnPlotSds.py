@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+# getnPlotSds.py
+#
+# Index of the SDS miniseed archive, used for the mseed source of getnPlot.py and panPlots.py
+#
+# Day files are laid out as  NET/STA/yyyy.ddd.NET.STA.LOC.CHA.mseed  under the archive.
+# For each day file the index holds the offset, length and time span of every record,
+# kept in an sqlite database in the cache directory.  Files are indexed the first time
+# they are wanted, and again only when their size or time changes; a file that has
+# grown (today's) only has its new records read.  Directory listings are kept too,
+# and reused until the directory changes.
+#
+# Only files of wanted channels that overlap a window are read, and of those only the
+# records that overlap it are decoded, so a short window costs the same wherever it
+# falls in the day.  The time coverage of any channel can be found without reading
+# any waveform data.
+#
+# Each day file wanted is read and decoded in its own task on a pool of threads, so
+# many channels over NFS take about as long as the slowest file rather than the sum
+# of them all.  The pieces of a channel are trimmed as views of the decoded arrays and
+# copied once, into one array for the channel.
+#
+# Availability from the command line:
+#   getnPlotSds.py NET.STA.LOC.CHA yyyy-mm-ddThh:mm:ss yyyy-mm-ddThh:mm:ss
+# with wildcards allowed in the channel codes.
+#
+
+
+
+############  Imports
+import io
+import os
+import sys
+import mmap
+import json
+import sqlite3
+import struct
+import warnings
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from fnmatch import fnmatch
+import numpy as np
+import obspy
+from obspy.core import UTCDateTime, Stream
+
+import getnPlotBlock
+
+
+
+############  Constants
+pathMseedDefault = '/mnt/mvohvs3/MVOSeisD6/mseed'
+cacheDirDefault = '~/.cache/getnPlot'
+secondsInDay = 86400
+# Day files read at once
+readThreadsDefault = 8
+recordDtype = np.dtype([ ('offset', '<i8'), ('reclen', '<i4'), ('npts', '<i4'), ('start', '<f8'), ('end', '<f8'), ('rate', '<f8') ])
+
+
+
+############  Warnings
+# Day files are decoded in several threads at once, where catch_warnings is not safe, so obspy's
+# complaints about odd records are filtered once for the process instead
+warnings.filterwarnings( 'ignore', module='obspy.io.mseed' )
+
+
+
+############  recordHeaders: Function to read the fixed headers of miniseed records, returning an array of recordDtype
+def recordHeaders( buf, offset=0 ):
+    # start is the time of the first sample and end the time after the last, as timestamps.
+    # Records with no samples, such as log records, are left out.  Reading stops at
+    # anything that is not a record, or at a record cut short by the end of the buffer.
+
+    records = []
+    nbytes = len( buf )
+    while offset + 48 <= nbytes:
+        header = _recordHeader( buf, offset )
+        if header is None:
+            break
+        reclen, npts, start, rate = header
+        if offset + reclen > nbytes:
+            break
+        if npts > 0 and rate > 0:
+            records.append( ( offset, reclen, npts, start, start + npts / rate, rate ) )
+        offset += reclen
+
+    return np.array( records, dtype=recordDtype )
+
+
+
+############  _recordHeader: Function to decode one fixed header, returning (reclen, npts, start, rate) or None
+def _recordHeader( buf, offset ):
+
+    if buf[ offset+6:offset+7 ] not in ( b'D', b'R', b'Q', b'M' ):
+        return None
+
+    # Byte order from a sensible year
+    for order in ( '>', '<' ):
+        year, doy = struct.unpack_from( order + 'HH', buf, offset+20 )
+        if 1900 <= year <= 2100 and 1 <= doy <= 366:
+            break
+    else:
+        return None
+
+    hour, minute, second, unused, fract, npts, rateFactor, rateMult, actFlags, ioFlags, qualFlags, nBlockettes, timeCorr, dataOffset, blocketteOffset = \
+        struct.unpack_from( order + 'BBBBHHhhBBBBiHH', buf, offset+24 )
+
+    # Record length from blockette 1000, and microseconds from blockette 1001
+    reclen = 0
+    microsec = 0
+    nextBlockette = blocketteOffset
+    for iblockette in range( max( nBlockettes, 1 ) ):
+        if nextBlockette < 48 or offset + nextBlockette + 4 > len( buf ):
+            break
+        blocketteType, blocketteNext = struct.unpack_from( order + 'HH', buf, offset+nextBlockette )
+        if blocketteType == 1000:
+            reclen = 2 ** buf[ offset+nextBlockette+6 ]
+        elif blocketteType == 1001:
+            microsec = struct.unpack_from( 'b', buf, offset+nextBlockette+5 )[0]
+        if blocketteNext == 0:
+            break
+        nextBlockette = blocketteNext
+    if reclen < 128:
+        return None
+
+    if rateFactor > 0 and rateMult > 0:
+        rate = float( rateFactor * rateMult )
+    elif rateFactor > 0 and rateMult < 0:
+        rate = -rateFactor / rateMult
+    elif rateFactor < 0 and rateMult > 0:
+        rate = -rateMult / rateFactor
+    elif rateFactor < 0 and rateMult < 0:
+        rate = 1.0 / ( rateFactor * rateMult )
+    else:
+        rate = 0.0
+
+    start = ( ( date( year, 1, 1 ).toordinal() + doy - 1 - 719163 ) * secondsInDay
+              + hour * 3600 + minute * 60 + second + fract * 1e-4 + microsec * 1e-6 )
+    # Time correction not yet applied
+    if not actFlags & 0x02:
+        start += timeCorr * 1e-4
+
+    return reclen, npts, start, rate
+
+
+
+############  coverage: Function to return the continuous (start, end) spans of records, end being the time after the last sample
+def coverage( records ):
+
+    if len( records ) == 0:
+        return []
+    records = np.sort( records, order='start' )
+    starts = records['start']
+    ends = np.maximum.accumulate( records['end'] )
+    # A gap of more than half a sample starts a new span
+    gaps = np.flatnonzero( starts[1:] > ends[:-1] + 0.5 / records['rate'][1:] ) + 1
+    begs = np.concatenate([ [0], gaps ])
+    lasts = np.concatenate([ gaps - 1, [ len( records ) - 1 ] ])
+
+    return [ ( float( starts[beg] ), float( ends[last] ) ) for beg, last in zip( begs, lasts ) ]
+
+
+
+############  readRecords: Function to read only the records of a miniseed file that overlap a window
+def readRecords( path, starttime, endtime, records=None ):
+    # The file is memory mapped and only the bytes of the records wanted are decoded.
+    # records are those of the file from its index; without them the file is
+    # binary searched on its record headers, as records of a day file are in time order.
+
+    beg = UTCDateTime( starttime ).timestamp
+    end = UTCDateTime( endtime ).timestamp
+    with open( path, 'rb' ) as fileMseed:
+        if os.fstat( fileMseed.fileno() ).st_size == 0:
+            return Stream()
+        with mmap.mmap( fileMseed.fileno(), 0, access=mmap.ACCESS_READ ) as buf:
+            if records is None:
+                ranges = _searchRecords( buf, beg, end )
+            else:
+                ranges = _selectRecords( records, beg, end )
+            if not ranges:
+                return Stream()
+            data = b''.join( buf[ first:last ] for first, last in ranges )
+
+    return obspy.read( io.BytesIO( data ), format='MSEED' )
+
+
+
+############  _selectRecords: Function to return byte ranges of indexed records that overlap a window
+def _selectRecords( records, beg, end ):
+
+    starts = records['start']
+    if len( starts ) > 1 and ( np.diff( starts ) >= 0 ).all():
+        # In time order, so the ends are too, and the records wanted run on from each other
+        first = np.searchsorted( records['end'], beg, side='right' )
+        last = np.searchsorted( starts, end, side='right' )
+        if first >= last:
+            return []
+        return [ ( int( records['offset'][first] ), int( records['offset'][last-1] + records['reclen'][last-1] ) ) ]
+
+    wanted = records[ ( starts <= end ) & ( records['end'] > beg ) ]
+    return [ ( int( offset ), int( offset + reclen ) ) for offset, reclen in zip( wanted['offset'], wanted['reclen'] ) ]
+
+
+
+############  _searchRecords: Function to binary search a file of fixed length records for those that overlap a window
+def _searchRecords( buf, beg, end ):
+
+    first = _recordHeader( buf, 0 )
+    if first is None:
+        return []
+    reclen = first[0]
+    nRecords = len( buf ) // reclen
+
+    def startOf( irecord ):
+        header = _recordHeader( buf, irecord * reclen )
+        if header is None or header[0] != reclen:
+            raise ValueError( 'record ' + str( irecord ) + ' is not ' + str( reclen ) + ' bytes' )
+        return header[2]
+
+    try:
+        # Last record starting before the window, which may run into it
+        lo, hi = 0, nRecords
+        while lo < hi:
+            mid = ( lo + hi ) // 2
+            if startOf( mid ) <= beg:
+                lo = mid + 1
+            else:
+                hi = mid
+        irecordFirst = max( 0, lo - 1 )
+        # First record starting after the window
+        lo, hi = irecordFirst, nRecords
+        while lo < hi:
+            mid = ( lo + hi ) // 2
+            if startOf( mid ) <= end:
+                lo = mid + 1
+            else:
+                hi = mid
+    except ValueError:
+        # Records of more than one length, so read the headers of all of them
+        return _selectRecords( recordHeaders( buf ), beg, end )
+    if lo <= irecordFirst:
+        return []
+
+    return [ ( irecordFirst * reclen, lo * reclen ) ]
+
+
+
+############  SdsIndex: Class for the index of an SDS archive
+class SdsIndex:
+
+    def __init__( self, pathMseed=pathMseedDefault, cacheDir=cacheDirDefault, threads=readThreadsDefault ):
+
+        self.pathMseed = pathMseed
+        self.pathDb = os.path.join( os.path.expanduser( cacheDir ), 'sds-index.sqlite' )
+        self.local = threading.local()
+        self.threads = max( 1, int( threads ) )
+        self.executor = None
+        self.executorPid = None
+
+    def _db( self ):
+
+        # sqlite connections can not be shared with forked processes, or between threads
+        if getattr( self.local, 'conn', None ) is not None and self.local.pid == os.getpid():
+            return self.local.conn
+        try:
+            os.makedirs( os.path.dirname( self.pathDb ), exist_ok=True )
+            conn = sqlite3.connect( self.pathDb, timeout=30 )
+            conn.execute( 'PRAGMA journal_mode=WAL' )
+        except ( OSError, sqlite3.Error ):
+            # No cache directory, so only index for this run
+            conn = sqlite3.connect( ':memory:' )
+        conn.execute( 'CREATE TABLE IF NOT EXISTS files ( path TEXT PRIMARY KEY, root TEXT, net TEXT, sta TEXT, loc TEXT, cha TEXT,'
+                      ' day INTEGER, size INTEGER, mtime INTEGER, starttime REAL, endtime REAL, records BLOB )' )
+        conn.execute( 'CREATE TABLE IF NOT EXISTS dirs ( path TEXT PRIMARY KEY, mtime INTEGER, names TEXT )' )
+        conn.execute( 'CREATE INDEX IF NOT EXISTS filesNslcDay ON files ( root, net, sta, loc, cha, day )' )
+        conn.commit()
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def _listDir( self, path ):
+        # Names in a directory, listed again only when it has changed
+
+        try:
+            mtime = os.stat( path ).st_mtime_ns
+        except OSError:
+            return []
+        db = self._db()
+        row = db.execute( 'SELECT mtime, names FROM dirs WHERE path = ?', ( path, ) ).fetchone()
+        if row is not None and row[0] == mtime:
+            return json.loads( row[1] )
+        try:
+            names = sorted( os.listdir( path ) )
+        except OSError:
+            return []
+        with db:
+            db.execute( 'INSERT OR REPLACE INTO dirs VALUES ( ?, ?, ? )', ( path, mtime, json.dumps( names ) ) )
+        return names
+
+    def _matching( self, path, pattern ):
+
+        if not any( char in pattern for char in '*?[' ):
+            return [ pattern ]
+        return [ name for name in self._listDir( path ) if fnmatch( name, pattern ) ]
+
+    def dayFiles( self, net, sta, loc, cha, day ):
+        # Paths of day files for channels matching the codes, day being days since 1970-01-01
+
+        if loc == '--':
+            loc = ''
+        dayDate = date.fromordinal( day + 719163 )
+        prefix = '%04d.%03d.' % ( dayDate.year, dayDate.timetuple().tm_yday )
+        paths = []
+        for netDir in self._matching( self.pathMseed, net ):
+            for staDir in self._matching( os.path.join( self.pathMseed, netDir ), sta ):
+                dirSta = os.path.join( self.pathMseed, netDir, staDir )
+                name = prefix + '.'.join([ netDir, staDir, loc, cha ]) + '.mseed'
+                if any( char in loc + cha for char in '*?[' ):
+                    paths += [ os.path.join( dirSta, nameDir ) for nameDir in self._listDir( dirSta )
+                               if nameDir.startswith( prefix ) and fnmatch( nameDir, name ) ]
+                else:
+                    paths.append( os.path.join( dirSta, name ) )
+        return paths
+
+    def entry( self, path ):
+        # Records of a day file, indexing it if new or changed, or None if there is no file
+
+        db = self._db()
+        try:
+            info = os.stat( path )
+        except OSError:
+            with db:
+                db.execute( 'DELETE FROM files WHERE path = ?', ( path, ) )
+            return None
+
+        row = db.execute( 'SELECT size, mtime, records FROM files WHERE path = ?', ( path, ) ).fetchone()
+        if row is not None and row[0] == info.st_size and row[1] == info.st_mtime_ns:
+            return np.frombuffer( row[2], dtype=recordDtype )
+
+        records = np.zeros( 0, dtype=recordDtype )
+        offset = 0
+        if row is not None and row[0] < info.st_size:
+            # Files that grow only have records added at the end
+            records = np.frombuffer( row[2], dtype=recordDtype )
+            if len( records ) > 0:
+                offset = int( records['offset'][-1] + records['reclen'][-1] )
+            else:
+                records = records[:0]
+        try:
+            with open( path, 'rb' ) as fileMseed:
+                fileMseed.seek( offset )
+                buf = fileMseed.read()
+        except OSError:
+            return None
+        recordsNew = recordHeaders( buf )
+        recordsNew['offset'] += offset
+        records = np.concatenate([ records, recordsNew ])
+
+        name = os.path.basename( path ).split( '.' )
+        net, sta, loc, cha = name[2:6] if len( name ) >= 7 else ( '', '', '', '' )
+        try:
+            day = date( int( name[0] ), 1, 1 ).toordinal() + int( name[1] ) - 1 - 719163
+        except ( ValueError, IndexError ):
+            day = -1
+        starttime = float( records['start'].min() ) if len( records ) else 0.0
+        endtime = float( records['end'].max() ) if len( records ) else 0.0
+        with db:
+            db.execute( 'INSERT OR REPLACE INTO files VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )',
+                        ( path, self.pathMseed, net, sta, loc, cha, day, info.st_size, info.st_mtime_ns,
+                          starttime, endtime, records.tobytes() ) )
+        return records
+
+    def files( self, net, sta, loc, cha, starttime, endtime ):
+        # (path, records) of day files of matching channels with records in the window
+
+        beg = UTCDateTime( starttime ).timestamp
+        end = UTCDateTime( endtime ).timestamp
+        found = []
+        for day in dayRange( starttime, endtime ):
+            for path in self.dayFiles( net, sta, loc, cha, day ):
+                records = self.entry( path )
+                if records is None or len( records ) == 0:
+                    continue
+                if ( ( records['start'] <= end ) & ( records['end'] > beg ) ).any():
+                    found.append( ( path, records ) )
+        return found
+
+    def availability( self, net='*', sta='*', loc='*', cha='*', starttime=None, endtime=None ):
+        # (net, sta, loc, cha, start, end) for each continuous span in the window, like a wave server menu,
+        # with end the time of the last sample
+
+        starttime = UTCDateTime( starttime )
+        endtime = UTCDateTime( endtime )
+        spans = {}
+        for path, records in self.files( net, sta, loc, cha, starttime, endtime ):
+            name = os.path.basename( path ).split( '.' )
+            spans.setdefault( tuple( name[2:6] ), [] ).append( records )
+
+        info = []
+        for nslc, recordsList in sorted( spans.items() ):
+            records = np.concatenate( recordsList )
+            delta = 1.0 / float( np.median( records['rate'] ) )
+            for beg, end in coverage( records ):
+                if beg <= endtime.timestamp and end > starttime.timestamp:
+                    info.append( nslc + ( UTCDateTime( beg ), UTCDateTime( end - delta ) ) )
+        return info
+
+    def _executor( self ):
+        # Kept for the life of the process, so its threads keep their database connections
+
+        if self.executor is None or self.executorPid != os.getpid():
+            self.executor = ThreadPoolExecutor( max_workers=self.threads )
+            self.executorPid = os.getpid()
+        return self.executor
+
+    def _readFile( self, path, starttime, endtime ):
+        # Traces of one day file in a window, trimmed, indexing the file if need be
+
+        records = self.entry( path )
+        if records is None or len( records ) == 0:
+            return []
+        if not ( ( records['start'] <= endtime.timestamp ) & ( records['end'] > starttime.timestamp ) ).any():
+            return []
+        try:
+            st = readRecords( path, starttime, endtime, records )
+        except ( OSError, ValueError, TypeError ):
+            return []
+        # Trimming takes views of the decoded arrays
+        st.trim( starttime, endtime )
+        return [ tr for tr in st if tr.stats.npts > 0 ]
+
+    def read( self, net, sta, loc, cha, starttime, endtime ):
+        # Channels matching the codes in the window, merged and trimmed, reading only the files needed
+
+        return self.readMany( [ ( net, sta, loc, cha, starttime, endtime ) ] )
+
+    def readMany( self, requests ):
+        # Channels of (net, sta, loc, cha, starttime, endtime) requests, codes allowing wildcards,
+        # with each day file read in a task of its own
+
+        tasks = []
+        for net, sta, loc, cha, starttime, endtime in requests:
+            starttime = UTCDateTime( starttime )
+            endtime = UTCDateTime( endtime )
+            for day in dayRange( starttime, endtime ):
+                for path in self.dayFiles( net, sta, loc, cha, day ):
+                    tasks.append( ( path, starttime, endtime ) )
+
+        if len( tasks ) > 1 and self.threads > 1:
+            pieces = list( self._executor().map( lambda task: self._readFile( *task ), tasks ) )
+        else:
+            pieces = [ self._readFile( *task ) for task in tasks ]
+
+        # Each channel is copied once into an array of its own, and split again at any gaps,
+        # the pieces being views of that array
+        st = Stream()
+        for tr in getnPlotBlock.mergeStream( Stream([ tr for traces in pieces for tr in traces ]) ):
+            if np.ma.isMaskedArray( tr.data ):
+                st += tr.split()
+            else:
+                st += tr
+        return st
+
+
+
+############  dayRange: Function to return the days since 1970-01-01 of the day files that may hold a window
+def dayRange( starttime, endtime ):
+
+    # Records that run over midnight are in the file of the day before
+    firstDay = int( UTCDateTime( starttime ).timestamp // secondsInDay ) - 1
+    lastDay = int( UTCDateTime( endtime ).timestamp // secondsInDay )
+    return range( firstDay, lastDay + 1 )
+
+
+
+############  sharedSdsIndex: Function to return an index kept for the life of the process
+indexes = {}
+
+def sharedSdsIndex( pathMseed=pathMseedDefault, cacheDir=cacheDirDefault ):
+
+    key = ( pathMseed, os.path.expanduser( cacheDir ) )
+    if key not in indexes:
+        indexes[key] = SdsIndex( pathMseed, cacheDir )
+    return indexes[key]
+
+
+
+############  Print availability when run from the command line
+if __name__ == '__main__':
+
+    if len( sys.argv ) != 4 or len( sys.argv[1].split( '.' ) ) != 4:
+        print( 'usage: getnPlotSds.py NET.STA.LOC.CHA starttime endtime' )
+        sys.exit( 2 )
+
+    net, sta, loc, cha = sys.argv[1].split( '.' )
+    index = sharedSdsIndex()
+    for net, sta, loc, cha, beg, end in index.availability( net, sta, loc, cha, sys.argv[2], sys.argv[3] ):
+        print( '.'.join([ net, sta, loc, cha ]), beg, end )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# getnPlotServe.py
+#
+# getnPlot server, started with:  getnPlot.py --mode serve
+# It listens on a unix socket and runs getnPlot jobs one at a time in the same process,
+# so obspy, matplotlib, wave server connections and caches stay loaded between plots.
+#
+# Sending a job from the command line (used by the getnPlot wrapper):
+#   getnPlotServe.py --send [getnPlot options]
+# Exit status is that of the job, or 75 if no server is running, so the caller can
+# fall back to running getnPlot.py itself.
+#
+# Only standard modules are imported at the top, so that sending a job is quick.
+#
+
+
+
+############  Imports
+import os
+import sys
+import json
+import signal
+import socket
+
+
+
+############  Constants
+socketDefault = '~/.cache/getnPlot/getnPlot.sock'
+statusNoServer = 75
+# Seconds a client has to send its job, or take the reply, before it is dropped
+requestTimeout = 10
+
+
+
+############  serve: Function to accept jobs on a unix socket until killed
+def serve( socketPath=socketDefault, runQuiet=False ):
+
+    import getnPlotRun
+
+    socketPath = os.path.expanduser( socketPath )
+    os.makedirs( os.path.dirname( socketPath ), exist_ok=True )
+
+    # Remove a socket left behind by a server that has gone, but not one that is still running
+    if os.path.exists( socketPath ):
+        if _serverRunning( socketPath ):
+            print( 'getnPlot server already running on ' + socketPath )
+            return 1
+        os.remove( socketPath )
+
+    server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    server.bind( socketPath )
+    os.chmod( socketPath, 0o600 )
+    server.listen( 16 )
+    # Tidy up the socket when killed, once any job running has finished, as jobs catch SystemExit
+    state = { 'busy': False, 'stop': False }
+    def stop( signum, frame ):
+        state['stop'] = True
+        if not state['busy']:
+            sys.exit( 0 )
+    signal.signal( signal.SIGTERM, stop )
+    if not runQuiet:
+        print( 'getnPlot server listening on ' + socketPath )
+
+    try:
+        while not state['stop']:
+            conn, addr = server.accept()
+            state['busy'] = True
+            try:
+                with conn:
+                    # A client that never sends a whole line must not hold up everyone else
+                    conn.settimeout( requestTimeout )
+                    try:
+                        job = json.loads( _readLine( conn ) )
+                    except ( ValueError, ConnectionError, socket.timeout ):
+                        continue
+                    if job.get( 'ping' ):
+                        try:
+                            _sendLine( conn, json.dumps( { 'status': 0 } ) )
+                        except OSError:
+                            pass
+                        continue
+                    argv = job.get( 'argv', [] )
+                    if _modeServe( argv ):
+                        reply = { 'status': 2, 'files': [], 'output': 'getnPlot server can not run --mode serve\n' }
+                    else:
+                        status, files, output = getnPlotRun.runJob( argv, job.get( 'cwd' ) )
+                        reply = { 'status': status, 'files': files, 'output': output }
+                    if not runQuiet:
+                        print( ' '.join( argv ) + '  -> ' + ' '.join( reply['files'] ) )
+                    try:
+                        _sendLine( conn, json.dumps( reply ) )
+                    except OSError:
+                        pass
+            finally:
+                state['busy'] = False
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists( socketPath ):
+            os.remove( socketPath )
+
+    return 0
+
+
+
+############  sendJob: Function to send a job to a running server, returning the reply, or None if there is no server
+def sendJob( argv, socketPath=socketDefault ):
+
+    socketPath = os.path.expanduser( socketPath )
+    if not os.path.exists( socketPath ):
+        return None
+    try:
+        conn = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        conn.connect( socketPath )
+    except OSError:
+        return None
+    with conn:
+        _sendLine( conn, json.dumps( { 'argv': list( argv ), 'cwd': os.getcwd() } ) )
+        try:
+            return json.loads( _readLine( conn ) )
+        except ( ValueError, ConnectionError ):
+            return None
+
+
+
+############  _modeServe: Function to check whether job arguments would start another server
+def _modeServe( argv ):
+
+    for iarg, arg in enumerate( argv ):
+        if arg == '--mode=serve':
+            return True
+        if arg == '--mode' and iarg+1 < len( argv ) and argv[iarg+1] == 'serve':
+            return True
+    return False
+
+
+
+############  _serverRunning: Function to check whether a server answers on a socket
+def _serverRunning( socketPath ):
+
+    try:
+        conn = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        conn.settimeout( 5 )
+        conn.connect( socketPath )
+    except OSError:
+        return False
+    with conn:
+        try:
+            _sendLine( conn, json.dumps( { 'ping': True } ) )
+            _readLine( conn )
+        except OSError:
+            return False
+    return True
+
+
+
+############  _sendLine, _readLine: Functions for newline-terminated messages on a socket
+def _sendLine( conn, text ):
+
+    conn.sendall( text.encode() + b'\n' )
+
+
+def _readLine( conn ):
+
+    chunks = []
+    while True:
+        chunk = conn.recv( 65536 )
+        if not chunk:
+            if chunks:
+                break
+            raise ConnectionError( 'connection closed' )
+        chunks.append( chunk )
+        if chunk.endswith( b'\n' ):
+            break
+    return b''.join( chunks ).decode()
+
+
+
+############  Send a job when run from the command line
+if __name__ == '__main__':
+
+    argv = sys.argv[1:]
+    if not argv or argv[0] != '--send':
+        print( 'usage: getnPlotServe.py --send [getnPlot options]' )
+        sys.exit( 2 )
+    argv = argv[1:]
+
+    socketPath = os.environ.get( 'GETNPLOT_SOCKET', socketDefault )
+    reply = sendJob( argv, socketPath )
+    if reply is None:
+        sys.exit( statusNoServer )
+
+    sys.stdout.write( reply.get( 'output', '' ) )
+    sys.exit( reply.get( 'status', 1 ) )
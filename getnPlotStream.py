@@ -0,0 +1,596 @@
+#!/usr/bin/env python
+# getnPlotStream.py
+#
+# Processing of data for getnPlot.py, for whole windows and, for windows longer than
+# a day, in chunks so that memory does not grow with the length of the window
+#
+# Long windows are fetched from the miniseed archive an hour (--chunk) at a time.
+# Each chunk is processed and reduced to the minimum and maximum in short time bins,
+# a few to each pixel of the plot, and only the reduced traces are kept.  These plot
+# the same as the full data, so a week of several stations needs no more memory than
+# an hour of them plus the bins.
+#
+# Chunks are processed by ChunkProcessor, whose stages carry their state from one
+# chunk to the next: filters are the same second order sections as obspy uses, run
+# with their state carried over, and decimation keeps its place between chunks, so
+# these give the same samples as processing the whole window (to 1e-13).  Otherwise:
+#  - demean takes the mean of the first chunk of each trace, not of the whole trace,
+#    so results differ by a constant, and by the response of the filters to it at the
+#    start of the trace (gone after ten periods of the lowest filter corner);
+#  - the envelope is taken with envelopeSeconds, or envelopePeriods of the lowest
+#    filter corner, of data each side of each piece, and away from the ends of the
+#    trace differs from that of the whole trace by less than 1e-3 of its largest value;
+#  - the envelope of the end of each chunk comes out with the next chunk.
+# A gap starts each stage afresh, as it does when processing the whole window.
+#
+
+
+
+############  Imports
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.signal import iirfilter, sosfilt, cheb2ord, cheby2, hilbert
+from scipy.fft import next_fast_len
+from obspy.core import UTCDateTime, Stream, Trace
+
+import rodsPythonThings
+import getnPlotDraw
+import getnPlotBlock
+
+
+
+############  Constants
+# Windows longer than this are read in chunks when they can be
+longWindowSeconds = 86400
+# Bins to each pixel across the plot
+binsPerPixel = 4
+# Data each side of each piece of envelope, in seconds and in periods of the lowest filter corner
+envelopeSeconds = 300.0
+envelopePeriods = 10.0
+
+
+
+############  processStream: Function to process a stream as getnPlot.py does, before plotting
+def processStream( st, lpFilt=0.0, hpFilt=0.0, integrate=False, downsample=1, vec=False,
+                   absolute=False, sqrt=False, log=False, env=False, taper=False, jobs=1 ):
+    # With jobs above 1, stations are processed in parallel threads; filters and
+    # FFTs run outside the GIL.  Jobs of a batch or layout are already in parallel,
+    # so process on their own.
+
+    options = ( lpFilt, hpFilt, integrate, downsample, vec, absolute, sqrt, log, env, taper )
+    groups = stationGroups( st )
+    if jobs <= 1 or len( groups ) <= 1 or multiprocessing.current_process().daemon:
+        return _processGroup( st, options )
+
+    with ThreadPoolExecutor( max_workers=min( jobs, len( groups ) ) ) as executor:
+        results = list( executor.map( lambda positions: _processGroup( Stream([ st[position] for position in positions ]), options ),
+                                      groups ) )
+
+    # Traces back in the order they came, or one for each station for vec
+    out = [ [] for tr in st ]
+    for positions, stGroup in zip( groups, results ):
+        if len( stGroup ) == len( positions ):
+            for position, tr in zip( positions, stGroup ):
+                out[position] = [ tr ]
+        else:
+            out[positions[0]] = list( stGroup )
+
+    return Stream([ tr for trs in out for tr in trs ])
+
+
+
+############  stationGroups: Function to return the positions of the traces of each station, in the order stations come
+def stationGroups( st ):
+
+    groups = {}
+    for position, tr in enumerate( st ):
+        groups.setdefault( tr.stats.station, [] ).append( position )
+
+    return list( groups.values() )
+
+
+
+############  _processGroup: Function to process a stream, or the traces of some stations, on one thread
+def _processGroup( st, options ):
+
+    lpFilt, hpFilt, integrate, downsample, vec, absolute, sqrt, log, env, taper = options
+    st = filterStream( st, lpFilt, hpFilt, integrate, downsample )
+    if vec:
+        st = vectorStream( st )
+    if absolute:
+        st = rodsPythonThings.streamFiddle( st, 'abs' )
+    if sqrt:
+        st = rodsPythonThings.streamFiddle( st, 'sqrt' )
+    if log:
+        st = rodsPythonThings.streamFiddle( st, 'log' )
+    if env:
+        st = envelopeStream( st )
+    if taper:
+        st = rodsPythonThings.streamFiddle( st, 'taper' )
+
+    return st
+
+
+
+############  filterSos: Function to return the second order sections obspy filters with, for a sampling rate
+def filterSos( btype, freqs, df, corners=4 ):
+    # As obspy.signal.filter lowpass, highpass and bandpass, which Trace.filter uses
+
+    fe = 0.5 * df
+    if btype == 'bandpass':
+        freqmin, freqmax = freqs
+        if freqmax / fe - 1.0 > -1e-6:
+            # obspy applies a highpass instead
+            return filterSos( 'highpass', [ freqmin ], df, corners )
+        if freqmin / fe > 1:
+            raise ValueError( 'Selected low corner frequency is above Nyquist.' )
+        return iirfilter( corners, [ freqmin / fe, freqmax / fe ], btype='band', ftype='butter', output='sos' )
+    if btype == 'highpass' and freqs[0] / fe > 1:
+        raise ValueError( 'Selected corner frequency is above Nyquist.' )
+
+    return iirfilter( corners, freqs[0] / fe, btype=btype, ftype='butter', output='sos' )
+
+
+
+############  decimateSos: Function to return the anti-alias filter obspy decimates with, as second order sections
+def decimateSos( factor, df, maxorder=12 ):
+    # As obspy.signal.filter.lowpass_cheby_2, which Trace.decimate uses
+
+    nyquist = df * 0.5
+    rp, rs, order = 1, 96, 1e99
+    ws = df * 0.5 / float( factor ) / nyquist
+    wp = ws
+    while order > maxorder:
+        wp = wp * 0.99
+        order, wn = cheb2ord( wp, ws, rp, rs, analog=0 )
+
+    return cheby2( order, rs, wn, btype='low', analog=0, output='sos' )
+
+
+
+############  cachedSos: Function to return the second order sections of a filter, designed once for each rate
+sosCache = {}
+
+def cachedSos( kind, freqs, df, corners=4 ):
+    # kind is lowpass, highpass, bandpass, or decimate with freqs the factor
+
+    key = ( kind, tuple( freqs ), float( df ), corners )
+    if key not in sosCache:
+        if kind == 'decimate':
+            sosCache[key] = decimateSos( int( freqs[0] ), df )
+        else:
+            sosCache[key] = filterSos( kind, freqs, df, corners )
+    return sosCache[key]
+
+
+
+############  applySos: Function to filter each row of an array, forwards and backwards for zero phase as obspy does
+def applySos( sos, data, zerophase=False ):
+
+    if zerophase:
+        firstpass = np.flip( sosfilt( sos, data, axis=1 ), axis=1 )
+        return np.flip( sosfilt( sos, firstpass, axis=1 ), axis=1 )
+
+    return sosfilt( sos, data, axis=1 )
+
+
+
+############  traceGroups: Function to return the positions of traces with the same sampling rate and length
+def traceGroups( st ):
+
+    groups = {}
+    for position, tr in enumerate( st ):
+        key = ( tr.stats.sampling_rate, tr.stats.npts, np.ma.isMaskedArray( tr.data ) )
+        groups.setdefault( key, [] ).append( position )
+
+    return groups
+
+
+
+############  filterStream: Function to demean, filter and decimate a stream as processStream does, a group of traces at a time
+def filterStream( st, lpFilt=0.0, hpFilt=0.0, integrate=False, downsample=1, zerophase=False ):
+    # Traces with the same rate and length are stacked in one array and each filter
+    # is run once along its rows, giving the same samples as Stream.filter and
+    # Stream.decimate.  zerophase is as for Stream.filter; decimation is never zero phase.
+
+    downsample = int( downsample )
+    if downsample > 16:
+        raise ArithmeticError( 'Automatic filter design is unstable for decimation factors above 16. '
+                               'Manual decimation is necessary.' )
+
+    # Processed traces at the place of each trace
+    results = [ [ tr ] for tr in st ]
+    for ( df, npts, masked ), positions in traceGroups( st ).items():
+        if npts == 0:
+            continue
+        trs = [ st[position] for position in positions ]
+        if masked:
+            # Filters are not run across gaps, so masked traces are split first and merged again after
+            for position, tr in zip( positions, trs ):
+                pieces = filterStream( Stream([ tr ]).split(), lpFilt, hpFilt, integrate, downsample, zerophase )
+                results[position] = list( getnPlotBlock.mergeStream( pieces ) )
+            continue
+
+        data = np.vstack([ tr.data.astype( np.float64 ) for tr in trs ])
+        data -= data.mean( axis=1, keepdims=True )
+        if lpFilt > 0.0:
+            data = applySos( cachedSos( 'lowpass', [ lpFilt ], df ), data, zerophase )
+        data -= data.mean( axis=1, keepdims=True )
+        if hpFilt > 0.0:
+            data = applySos( cachedSos( 'highpass', [ hpFilt ], df ), data, zerophase )
+        if integrate:
+            data = applySos( cachedSos( 'bandpass', [ 0.003, 0.1 ], df ), data, zerophase )
+        if downsample > 1:
+            data = applySos( cachedSos( 'decimate', [ downsample ], df ), data )[ :, ::downsample ]
+        data -= data.mean( axis=1, keepdims=True )
+
+        for row, tr in enumerate( trs ):
+            tr.data = np.ascontiguousarray( data[row] )
+            if downsample > 1:
+                tr.stats.sampling_rate = df / float( downsample )
+
+    st.traces = [ tr for trs in results for tr in trs ]
+
+    return st
+
+
+
+############  envelopeRows: Function to return the envelope of each row of an array
+def envelopeRows( data ):
+    # Rows are padded with zeros to a length the FFT is fast for, so the time
+    # taken does not depend on whether the number of samples has large prime factors
+
+    npts = data.shape[1]
+    analytic = hilbert( data, N=next_fast_len( npts ), axis=1 )[ :, :npts ]
+
+    return np.abs( analytic )
+
+
+
+############  envelopeStream: Function to replace the data of each trace by its envelope, traces of the same length together
+def envelopeStream( st ):
+
+    groups = {}
+    for tr in st:
+        if tr.stats.npts > 0:
+            groups.setdefault( tr.stats.npts, [] ).append( tr )
+    for trs in groups.values():
+        envelopes = envelopeRows( np.vstack([ np.ma.getdata( tr.data ).astype( np.float64 ) for tr in trs ]) )
+        for row, tr in enumerate( trs ):
+            if np.ma.isMaskedArray( tr.data ):
+                tr.data = np.ma.masked_array( envelopes[row], mask=np.ma.getmaskarray( tr.data ) )
+            else:
+                tr.data = envelopes[row]
+
+    return st
+
+
+
+############  vectorStream: Function to return the vector sum of the channels of each station, stations of the same length together
+def vectorStream( st ):
+    # One trace for each station, with the header of its first channel, as long as its shortest channel
+
+    stations = {}
+    for tr in st:
+        stations.setdefault( tr.stats.station, [] ).append( tr )
+
+    # Stations with the same number of channels and samples are stacked as (stations, channels, samples)
+    groups = {}
+    for sta, trs in stations.items():
+        npts = min( tr.stats.npts for tr in trs )
+        groups.setdefault( ( len( trs ), npts ), [] ).append( sta )
+    sums = {}
+    for ( nChannels, npts ), stas in groups.items():
+        data = np.empty( ( len( stas ), nChannels, npts ) )
+        for ista, sta in enumerate( stas ):
+            for icha, tr in enumerate( stations[sta] ):
+                data[ ista, icha ] = np.ma.getdata( tr.data[:npts] )
+        for sta, row in zip( stas, np.sqrt( np.einsum( 'ijk,ijk->ik', data, data ) ) ):
+            sums[sta] = row
+
+    out = Stream()
+    for sta, trs in stations.items():
+        data = sums[sta]
+        # Gaps in any channel are gaps in the sum
+        if any( np.ma.isMaskedArray( tr.data ) for tr in trs ):
+            mask = np.zeros( len( data ), dtype=bool )
+            for tr in trs:
+                mask |= np.ma.getmaskarray( tr.data )[ :len( data ) ]
+            data = np.ma.masked_array( data, mask=mask )
+        header = trs[0].stats.copy()
+        # obspy keeps npts from a header it is given, and the sum is as long as the shortest channel
+        header.npts = len( data )
+        out += Trace( data=data, header=header )
+
+    return out
+
+
+
+############  ChunkState: Class holding what the stages of ChunkProcessor carry over for one trace
+class ChunkState:
+
+    def __init__( self, stats, sos ):
+
+        self.stats = stats.copy()
+        self.starttime = stats.starttime
+        self.delta = stats.delta
+        # Samples taken in, and given out
+        self.nIn = 0
+        # Mean taken off before each filter, from the first chunk
+        self.means = [ None, None, None ]
+        # Filter states, zero as for a whole trace
+        self.zi = dict( ( name, np.zeros( ( len( sections ), 2 ) ) ) for name, sections in sos.items() )
+        # Envelope input not yet given out, after context already given out
+        self.envData = np.empty( 0 )
+        self.envDone = 0
+        self.nOut = 0
+
+    def expected( self ):
+        # Time of the next sample
+
+        return self.starttime + self.nIn * self.delta
+
+
+
+############  ChunkProcessor: Class to process a stream a chunk at a time, as processStream does a whole window
+class ChunkProcessor:
+    # Chunks may overlap, and samples already processed are dropped.  Each sample
+    # comes out once, from process() or, for the end of envelopes, from flush().
+
+    def __init__( self, lpFilt=0.0, hpFilt=0.0, integrate=False, downsample=1,
+                  absolute=False, sqrt=False, log=False, env=False ):
+
+        self.lpFilt = lpFilt
+        self.hpFilt = hpFilt
+        self.integrate = integrate
+        self.downsample = int( downsample )
+        self.absolute = absolute
+        self.sqrt = sqrt
+        self.log = log
+        self.env = env
+        self.states = {}
+        # Longer for filters that pass long periods
+        corners = [ freq for freq in ( lpFilt, hpFilt ) if freq > 0.0 ] + ( [ 0.003 ] if integrate else [] )
+        self.envelopeSeconds = max( [ envelopeSeconds ] + [ envelopePeriods / freq for freq in corners ] )
+
+    def _sos( self, df ):
+        # Filters for a sampling rate, by stage
+
+        sos = {}
+        if self.lpFilt > 0.0:
+            sos['lowpass'] = cachedSos( 'lowpass', [ self.lpFilt ], df )
+        if self.hpFilt > 0.0:
+            sos['highpass'] = cachedSos( 'highpass', [ self.hpFilt ], df )
+        if self.integrate:
+            sos['integrate'] = cachedSos( 'bandpass', [ 0.003, 0.1 ], df )
+        if self.downsample > 1:
+            sos['decimate'] = cachedSos( 'decimate', [ self.downsample ], df )
+        return sos
+
+    def _filter( self, state, name, data ):
+
+        sos = self._sos( state.stats.sampling_rate )
+        if name not in sos:
+            return data
+        data, state.zi[name] = sosfilt( sos[name], data, zi=state.zi[name] )
+        return data
+
+    def _demean( self, state, stage, data ):
+
+        if state.means[stage] is None and len( data ) > 0:
+            state.means[stage] = data.mean()
+        if state.means[stage] is None:
+            return data
+        return data - state.means[stage]
+
+    def _output( self, state, data, nBefore, delta ):
+        # Trace of processed samples following nBefore already given out
+
+        tr = Trace( data=data )
+        tr.stats.network = state.stats.network
+        tr.stats.station = state.stats.station
+        tr.stats.location = state.stats.location
+        tr.stats.channel = state.stats.channel
+        tr.stats.calib = state.stats.calib
+        tr.stats.delta = delta
+        tr.stats.starttime = state.starttime + nBefore * delta
+        return tr
+
+    def _envelope( self, state, data, final=False ):
+        # Envelope of the samples that have enough data after them, or of all at the end
+
+        if not self.env:
+            return data
+        pad = int( round( self.envelopeSeconds / ( state.delta * max( 1, self.downsample ) ) ) )
+        buffer = np.concatenate([ state.envData, data ])
+        nReady = len( buffer ) if final else len( buffer ) - pad
+        if nReady <= state.envDone:
+            state.envData = buffer
+            return np.empty( 0 )
+        out = envelopeRows( buffer[None, :] )[ 0, state.envDone:nReady ]
+        # Keep pad samples already given out as context for the next
+        keep = max( 0, nReady - pad )
+        state.envData = buffer[ keep: ]
+        state.envDone = nReady - keep
+        return out
+
+    def _run( self, state, data ):
+        # New samples of a trace through the stages, in the order of processStream, returning the samples that come out
+
+        nIn = len( data )
+        data = self._demean( state, 0, data )
+        data = self._filter( state, 'lowpass', data )
+        data = self._demean( state, 1, data )
+        data = self._filter( state, 'highpass', data )
+        data = self._filter( state, 'integrate', data )
+        if self.downsample > 1:
+            data = self._filter( state, 'decimate', data )
+            # Every downsample-th sample counting from the start of the trace
+            data = data[ ( -state.nIn ) % self.downsample::self.downsample ]
+        state.nIn += nIn
+        data = self._demean( state, 2, data )
+        # Sample by sample, so as for the whole window
+        for op, wanted in ( ( 'abs', self.absolute ), ( 'sqrt', self.sqrt ), ( 'log', self.log ) ):
+            if wanted and len( data ) > 0:
+                data = rodsPythonThings.streamFiddle( Stream([ Trace( data=data ) ]), op )[0].data
+        return self._envelope( state, data )
+
+    def _flushState( self, state ):
+        # Samples held back by the envelope for a trace
+
+        if not self.env:
+            return None
+        data = self._envelope( state, np.empty( 0 ), final=True )
+        if len( data ) == 0:
+            return None
+        tr = self._output( state, data, state.nOut, state.delta * max( 1, self.downsample ) )
+        state.nOut += len( data )
+        return tr
+
+    def process( self, st ):
+        # Processed samples of a chunk
+
+        out = Stream()
+        st = st.copy().split()
+        st.sort( keys=['network', 'station', 'location', 'channel', 'starttime'] )
+        for tr in st:
+            state = self.states.get( tr.id )
+            data = tr.data.astype( np.float64 )
+            if state is not None and abs( tr.stats.delta - state.delta ) < 1e-9 * state.delta:
+                # Drop samples already processed
+                skip = int( round( ( state.expected() - tr.stats.starttime ) / state.delta ) )
+                if skip >= len( data ):
+                    continue
+                if skip < 0:
+                    # A gap, so start again
+                    flushed = self._flushState( state )
+                    if flushed is not None:
+                        out += flushed
+                    state = None
+                else:
+                    data = data[ skip: ]
+            elif state is not None:
+                flushed = self._flushState( state )
+                if flushed is not None:
+                    out += flushed
+                state = None
+            if state is None:
+                state = ChunkState( tr.stats, self._sos( tr.stats.sampling_rate ) )
+                self.states[tr.id] = state
+
+            data = self._run( state, data )
+            if len( data ) > 0:
+                out += self._output( state, data, state.nOut, state.delta * max( 1, self.downsample ) )
+                state.nOut += len( data )
+
+        return out
+
+    def flush( self ):
+        # Samples still held back, once all chunks have been processed
+
+        out = Stream()
+        for state in self.states.values():
+            flushed = self._flushState( state )
+            if flushed is not None:
+                out += flushed
+        return out
+
+
+
+############  chunkWindows: Function to split a window into chunks, returning (starttime, endtime) of each
+def chunkWindows( starttime, endtime, chunkSeconds ):
+
+    starttime = UTCDateTime( starttime )
+    endtime = UTCDateTime( endtime )
+    windows = []
+    beg = starttime
+    while beg < endtime:
+        end = min( beg + chunkSeconds, endtime )
+        windows.append( ( beg, end ) )
+        beg = end
+
+    return windows
+
+
+
+############  MinMaxReducer: Class holding the minimum and maximum of each channel in time bins across a window
+class MinMaxReducer:
+
+    def __init__( self, starttime, endtime, binSeconds ):
+
+        self.starttime = UTCDateTime( starttime )
+        self.endtime = UTCDateTime( endtime )
+        self.binSeconds = float( binSeconds )
+        self.nBins = max( 1, int( np.ceil( ( self.endtime - self.starttime ) / self.binSeconds ) ) )
+        self.bins = {}
+        self.stats = {}
+
+    def add( self, st ):
+        # Traces are added a piece at a time, so must not overlap pieces already added
+
+        for tr in st:
+            if tr.stats.npts == 0:
+                continue
+            if tr.id not in self.bins:
+                self.bins[tr.id] = ( np.full( self.nBins, np.nan ), np.full( self.nBins, np.nan ) )
+                self.stats[tr.id] = tr.stats.copy()
+            mins, maxs = self.bins[tr.id]
+
+            # Bins the trace falls in, and the first sample in each
+            offset = tr.stats.starttime - self.starttime
+            delta = tr.stats.delta
+            first = max( 0, int( np.floor( offset / self.binSeconds ) ) )
+            last = min( self.nBins, int( np.floor( ( offset + ( tr.stats.npts - 1 ) * delta ) / self.binSeconds ) ) + 1 )
+            if last <= first:
+                continue
+            edges = np.ceil( ( np.arange( first, last + 1 ) * self.binSeconds - offset ) / delta - 1e-6 )
+            binMins, binMaxs = getnPlotDraw.minMaxColumns( tr.data, edges )
+            mins[first:last] = np.fmin( mins[first:last], binMins )
+            maxs[first:last] = np.fmax( maxs[first:last], binMaxs )
+
+    def stream( self ):
+        # Reduced traces: minimum then maximum of each bin, masked where there is no data
+
+        st = Stream()
+        for trid, ( mins, maxs ) in self.bins.items():
+            data = np.empty( 2 * self.nBins )
+            data[0::2] = mins
+            data[1::2] = maxs
+            tr = Trace( data=np.ma.masked_invalid( data ) )
+            stats = self.stats[trid]
+            tr.stats.network = stats.network
+            tr.stats.station = stats.station
+            tr.stats.location = stats.location
+            tr.stats.channel = stats.channel
+            tr.stats.calib = stats.calib
+            tr.stats.delta = self.binSeconds / 2
+            tr.stats.starttime = self.starttime + self.binSeconds / 4
+            if not np.ma.is_masked( tr.data ):
+                tr.data = tr.data.data
+            st += tr
+
+        return st
+
+
+
+############  reduceChunks: Function to fetch, process and reduce a long window chunk by chunk
+def reduceChunks( fetcher, starttime, endtime, binSeconds, chunkSeconds=3600, processor=None, runQuiet=True ):
+    # fetcher(starttime, endtime) returns a Stream for the window.
+    # processor is a ChunkProcessor, by default one that only demeans.
+
+    if processor is None:
+        processor = ChunkProcessor()
+    reducer = MinMaxReducer( starttime, endtime, binSeconds )
+    windows = chunkWindows( starttime, endtime, chunkSeconds )
+    for ichunk, ( beg, end ) in enumerate( windows ):
+        st = fetcher( beg, end )
+        stChunk = processor.process( st ) if len( st ) > 0 else Stream()
+        if ichunk == len( windows ) - 1:
+            stChunk += processor.flush()
+        reducer.add( stChunk )
+        if not runQuiet:
+            print( ' Chunk ' + str( ichunk + 1 ) + ' of ' + str( len( windows ) ) + ': ' + beg.strftime( '%Y-%m-%d %H:%M' ) +
+                   '  streams: ' + str( len( stChunk ) ) )
+
+    return reducer.stream()
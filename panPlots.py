@@ -24,9 +24,15 @@ sys.path.append( '/'.join( [os.path.expanduser('~'), 'src/pythonModules' ] ) )
 import rodsPythonThings
 import rodsPlotTfr as rodstfr
 
+import getnPlotFetch
+import getnPlotCache
+import getnPlotSds
+import getnPlotChannels
+
 from datetime import datetime, date, timedelta, time
 from dateutil import parser as dparser
 from dateutil.rrule import rrule, DAILY
+from fnmatch import fnmatch
 from obspy.clients.earthworm import Client
 from obspy.core import UTCDateTime, Stream, Trace
 from pathlib import Path
@@ -63,29 +69,46 @@ def plotPanacea( datimBeg, sta, gain, runQuiet ):
     wwsIP = "172.17.102.60"
     wwsPort = 16022
     dataSource = 'waveserver ' + str(wwsIP)
-    client = Client(wwsIP, wwsPort, clientTimeout)
-    info = client.get_availability(network=network, station=station, channel=channel)
+    pool = getnPlotFetch.WaveserverPool(wwsIP, wwsPort, clientTimeout, wwsConnections, getnPlotCache.MenuCache(cacheDir, menuTtl))
+    try:
+        info = pool.getAvailability(network=network, station=station, channel=channel)
+    except OSError:
+        info = []
+    info = getnPlotFetch.availableInWindow( info, datimBeg, datimEnd, pool.menuAge )
     if not runQuiet:
         print( info )
-    for n, s, l, c, start, end in info:
-        st += client.get_waveforms(n, s, l, c, datimBeg, datimEnd)
+    # A day of one channel is fetched in hour-long pieces, in parallel
+    nslcs = [ (n, s, l, c) for n, s, l, c, start, end in info ]
+    st += getnPlotFetch.fetchWaveserver( pool, nslcs, datimBeg, datimEnd, pieces=24 )
+    pool.close()
 
     if len(st) == 0:
         # Second try miniseed files
         dataSource = 'continuous miniseed data'
         if runQuiet:
             warnings.filterwarnings("ignore")
-        for netw in ["MV", "MC", "CU", "TR"]:
-            client = sdsClient(dirnameSeparator.join([pathMseed, netw]))
-            client.FMTSTR = '{station}/{year}.{doy:03d}.{network}.{station}.{location}.{channel}.mseed'
-            st += client.get_waveforms(netw, '*',
-                                           '*', '*', datimBeg, datimEnd)
+        # Only day files of this station that overlap the window are read, each in a thread of its own:
+        # the wanted channel, and the bands a vertical is chosen from when it is missing
+        sdsIndex = getnPlotSds.sharedSdsIndex( pathMseed, cacheDir )
+        nslcs = [ (network, station, '*', prefix + '?' * (3-len(prefix))) for prefix, needed in getnPlotChannels.bandsPrefer3c ]
+        if not any( fnmatch( channel, nslc[3] ) for nslc in nslcs ):
+            nslcs.insert( 0, (network, station, location, channel) )
+        st += getnPlotFetch.fetchSds( pathMseed, nslcs, datimBeg, datimEnd, index=sdsIndex )
         if runQuiet:
             warnings.filterwarnings("default")
 
     if not runQuiet:
         print('  Streams from ' + dataSource + ': ' + str(len(st)))
 
+    ############  Keep the wanted channel, or the vertical the station has if it is missing
+    channelIndex = getnPlotChannels.ChannelIndex( st )
+    traces = channelIndex.channel( sta )
+    if not traces:
+        for slot, tr in channelIndex.preferred( station, getnPlotChannels.bandsPrefer3c ):
+            if slot == 1:
+                traces = channelIndex.channel( tr.id )
+    st = Stream( traces )
+
     ############  Bug out if nothing got
     if len(st) == 0:
         if not runQuiet:
@@ -332,6 +355,9 @@ filenameSeparator = "."
 filenameSeparator2 = "-"
 dirnameSeparator = "/"
 clientTimeout = 20
+cacheDir = '~/.cache/getnPlot'
+menuTtl = 300
+wwsConnections = 6
 today = datetime.utcnow().date()
 datimNow = datetime.utcnow()
 